@@ -0,0 +1,142 @@
+"""
+Electrometer acquisition
+Readings are streamed from the electrometer by an asyncio reader running on
+a background thread and posted to the GUI one at a time, filling the empty
+MU level/repeat slots in order. The transport is pluggable; only a simulated
+UNIDOS that produces charges in proportion to the MU delivered is provided.
+
+A real UNIDOS answers serial queries rather than streaming readings, and its
+remote protocol has not been implemented or checked against a device, so
+serial ports are not supported yet. A Transport for it must send the
+measurement query and return each answer as one line in the format below.
+
+Each measurement is one line "V;<charge>;<unit>;<range>",
+e.g. "V;1.0234E-09;C;HIGH".
+"""
+
+import asyncio
+import queue
+import threading
+import time
+
+import numpy as np
+
+READ_TIMEOUT = 0.5 # seconds a transport waits for a line before the reader checks for stop
+UNITS = {'C': 1e9, 'mC': 1e6, 'uC': 1e3, 'nC': 1., 'pC': 1e-3} # to nC
+RANGES = {'LOW': 'Low', 'MED': 'Medium', 'MEDIUM': 'Medium', 'HIGH': 'High'}
+
+
+def parse_line(line):
+    '''(charge in nC, range name) from one measurement line, or None if it is not a reading'''
+    if isinstance(line, bytes):
+        line = line.decode('ascii', errors='ignore')
+    parts = [p.strip() for p in line.strip().split(';')]
+    if len(parts) < 3 or parts[0] != 'V' or parts[2] not in UNITS:
+        return None
+    try:
+        value = float(parts[1])*UNITS[parts[2]]
+    except ValueError:
+        return None
+    rng = RANGES.get(parts[3].upper()) if len(parts) > 3 else None
+    return value, rng
+
+
+class Transport():
+    '''Line-oriented connection to an electrometer'''
+    def open(self):
+        pass
+
+    def readline(self):
+        '''Next line, or None if nothing arrived within READ_TIMEOUT'''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SimulatedUnidos(Transport):
+    '''Stand-in UNIDOS: one reading per delivered beam of mu[j] MU, interval seconds apart'''
+    def __init__(self, mu, nc_per_mu=0.2, noise=0.002, interval=0.5, rng='HIGH', seed=None):
+        self.lines = queue.Queue()
+        self.mu = list(mu)
+        self.nc_per_mu = nc_per_mu
+        self.noise = noise
+        self.interval = interval
+        self.rng = rng
+        self.random = np.random.default_rng(seed)
+        self.next_time = None
+
+    def open(self):
+        for m in self.mu:
+            charge = m*self.nc_per_mu*(1 + self.noise*self.random.standard_normal())*1e-9
+            self.lines.put('V;%.4E;C;%s\r\n' % (charge, self.rng))
+        self.next_time = time.monotonic()+self.interval
+
+    def readline(self):
+        wait = self.next_time-time.monotonic()
+        if wait > READ_TIMEOUT:
+            time.sleep(READ_TIMEOUT)
+            return None
+        time.sleep(max(0, wait))
+        try:
+            line = self.lines.get_nowait()
+        except queue.Empty:
+            time.sleep(READ_TIMEOUT)
+            return None
+        self.next_time += self.interval
+        return line
+
+
+def open_transport(port, mu=None):
+    '''Transport for a port name; 'sim' gives a simulated UNIDOS delivering the mu list'''
+    if port == 'sim':
+        return SimulatedUnidos(mu or [])
+    raise ValueError("Electrometer port "+str(port)+" not supported: the UNIDOS serial protocol is not implemented")
+
+
+class Acquisition():
+    '''
+        Fill slots [(MU level, repeat), ...] in order from a transport.
+        callback(i, k, charge_nC, range) for each reading; done() when finished or stopped.
+    '''
+    def __init__(self, transport, slots, callback, done=None):
+        self.transport = transport
+        self.slots = list(slots)
+        self.callback = callback
+        self.done = done
+        self._stop = threading.Event()
+        self._thread = None
+
+    async def _next_reading(self, loop):
+        while not self._stop.is_set():
+            line = await loop.run_in_executor(None, self.transport.readline)
+            reading = parse_line(line) if line else None
+            if reading:
+                return reading
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.transport.open)
+            for i, k in self.slots:
+                reading = await self._next_reading(loop)
+                if reading is None:
+                    break
+                self.callback(i, k, *reading)
+        except Exception as e:
+            print("Acquisition error: "+str(e))
+        finally:
+            self.transport.close()
+            if self.done:
+                self.done()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._run(),), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
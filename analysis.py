@@ -0,0 +1,353 @@
+"""
+Headless dose linearity analysis engine
+Vectorised over sessions: readings are a masked array shaped
+(sessions x MU levels x repeats) with blank readings masked.
+No GUI or database dependencies so it can be imported for batch work.
+"""
+
+import datetime
+
+import numpy as np
+
+ADATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# action levels: max CoV of any MU level (%) and the allowed chi range
+COV_THRESHOLD = 0.5
+CHI_THRESHOLD = [0, 0.2]
+
+MC_DRAWS = 200000 # Monte Carlo draws for the chi uncertainty
+MC_CHUNK = 25000 # draws per batch, bounds memory to a few MB
+
+
+class BatchAnalysis:
+    '''Per-session, per-MU-level analysis results as masked arrays'''
+    def __init__(self):
+        self.MU = None              # (S,M) MU per spot
+        self.n = None               # (S,M) number of valid readings
+        self.Rmean = None           # (S,M) mean reading
+        self.Rstd = None            # (S,M) population std of readings
+        self.cov = None             # (S,M) coefficient of variation (%)
+        self.Rratio = None          # (S,M) Rmean / Rmean of first valid level
+        self.MUratio = None         # (S,M) MU / MU of first valid level
+        self.Rdifflinearity = None  # (S,M) linearity deviation (%)
+        self.slope = None           # (S,) slope of the fit through the origin
+        self.slope_err = None       # (S,) standard error of the slope
+        self.prn = None             # (S,) chi statistic
+        self.analysed = None        # (S,) True if more than one MU level measured
+
+
+def readings_array(rlist, n_repeats=None):
+    '''Convert nested [session][MU level][repeat] readings to a masked array; blanks are masked'''
+    n_mu = max((len(s) for s in rlist), default=0)
+    if n_repeats is None:
+        n_repeats = max((len(r) for s in rlist for r in s), default=0)
+    data = np.zeros((len(rlist), n_mu, n_repeats))
+    mask = np.ones(data.shape, dtype=bool)
+    for i, s in enumerate(rlist):
+        for j, r in enumerate(s):
+            for k, val in enumerate(r):
+                if val is not None and val != '':
+                    data[i, j, k] = float(val)
+                    mask[i, j, k] = False
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def mu_array(mulist):
+    '''Convert nested [session][MU level] MU values to a masked array; blanks are masked'''
+    n_mu = max((len(s) for s in mulist), default=0)
+    data = np.zeros((len(mulist), n_mu))
+    mask = np.ones(data.shape, dtype=bool)
+    for i, s in enumerate(mulist):
+        for j, val in enumerate(s):
+            if val is not None and val != '':
+                data[i, j] = float(val)
+                mask[i, j] = False
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def _first_valid(arr, valid):
+    '''Value of arr at the first valid MU level of each session'''
+    ref = np.argmax(valid, axis=1)[:, None]
+    return np.take_along_axis(arr, ref, axis=1)
+
+
+def fit_origin(mu, rmean, valid, rstd=None):
+    '''
+        Least squares line through the origin, y = a*x, for every session at once.
+        Weighted by 1/rstd**2 if rstd is given; sessions with a zero or missing
+        std at any valid level fall back to equal weights.
+        Returns (a, a_err); a_err is nan with fewer than two valid levels.
+    '''
+    x = np.where(valid, mu, 0.)
+    y = np.where(valid, rmean, 0.)
+    w = valid.astype(float)
+    if rstd is not None:
+        s = np.where(valid, rstd, 1.)
+        ok = np.all(np.isfinite(s) & (s > 0), axis=1, keepdims=True)
+        with np.errstate(divide='ignore'):
+            w = np.where(ok & valid, 1/np.where(ok, s, 1.)**2, w)
+    n = valid.sum(axis=1)
+    swxx = (w*x*x).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (w*x*y).sum(axis=1)/swxx
+        chisq = (w*(y - a[:, None]*x)**2).sum(axis=1)
+        a_err = np.where(n > 1, np.sqrt(chisq/(n-1)/swxx), np.nan)
+    return a, a_err
+
+
+def chi_statistic(mu, rmean, valid, a, b):
+    '''prn = ChiSq[predicted from MU ratios] - ChiSq[linear fit], per session'''
+    x = np.where(valid, mu, np.nan)
+    y = np.where(valid, rmean, np.nan)
+    y_pred = x/_first_valid(x, valid)*_first_valid(y, valid)
+    y_fit = np.asarray(a)[:, None]*x + np.asarray(b)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prn = np.nansum(y**2/y_pred, axis=1) - np.nansum(y**2/y_fit, axis=1)
+    return np.abs(prn)
+
+
+def chi_uncertainty(mu, rmean, rstd, n, threshold, draws=MC_DRAWS, chunk=MC_CHUNK, level=95, seed=None):
+    '''
+        Monte Carlo uncertainty of the chi statistic for one session.
+        Each draw resamples every level's mean from N(Rmean, std of the mean), refits
+        the line through the origin and recomputes prn, in chunks of draws at a time.
+        Returns (prn_low, prn_high, p_pass): the central level% interval and the
+        fraction of draws inside threshold = [low, high].
+    '''
+    mu = np.asarray(mu, dtype=float)
+    rmean = np.asarray(rmean, dtype=float)
+    # Rstd is the population std, so the sample std of the mean is std/sqrt(n-1)
+    sem = np.asarray(rstd, dtype=float)/np.sqrt(np.maximum(np.asarray(n)-1, 1))
+    rng = np.random.default_rng(seed)
+    prn = np.empty(draws)
+    valid = np.ones((1, mu.size), dtype=bool)
+    for start in range(0, draws, chunk):
+        size = min(chunk, draws-start)
+        y = rmean + sem*rng.standard_normal((size, mu.size))
+        x = np.broadcast_to(mu, y.shape)
+        a, _ = fit_origin(x, y, valid)
+        prn[start:start+size] = chi_statistic(x, y, valid, a, np.zeros_like(a))
+    low, high = np.percentile(prn, [(100-level)/2, (100+level)/2])
+    p_pass = np.mean((prn >= threshold[0]) & (prn <= threshold[1]))
+    return low, high, p_pass
+
+
+def analyse(readings, mu, weighted=False):
+    '''
+        Analyse a batch of sessions in one call.
+        readings: masked array (S,M,K); mu: masked array (S,M) or (M,)
+        weighted: weight the fit by 1/Rstd**2
+    '''
+    readings = np.ma.asarray(readings, dtype=float)
+    if readings.ndim == 2:
+        readings = readings[None]
+    mu = np.ma.asarray(mu, dtype=float)
+    mu = np.ma.MaskedArray(np.broadcast_to(mu.filled(np.nan), readings.shape[:2]),
+                           mask=np.broadcast_to(np.ma.getmaskarray(mu), readings.shape[:2]))
+
+    rmask = np.ma.getmaskarray(readings)
+    r = readings.filled(0.)
+    n = (~rmask).sum(axis=2)
+    valid = (n > 0) & ~np.ma.getmaskarray(mu)
+    mu_f = mu.filled(np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rmean = r.sum(axis=2)/n
+        rstd = np.sqrt(np.where(rmask, 0., (r - rmean[..., None])**2).sum(axis=2)/n)
+        rmean = np.where(valid, rmean, np.nan)
+        rstd = np.where(valid, rstd, np.nan)
+        rratio = rmean/_first_valid(rmean, valid)
+        muratio = mu_f/_first_valid(mu_f, valid)
+        rdiff = rratio/muratio*100 - 100
+        cov = rstd/rmean*100
+
+    a, a_err = fit_origin(mu_f, rmean, valid, rstd if weighted else None)
+    invalid = ~valid
+    res = BatchAnalysis()
+    res.MU = np.ma.MaskedArray(mu_f, mask=invalid)
+    res.n = n
+    res.Rmean = np.ma.MaskedArray(rmean, mask=invalid)
+    res.Rstd = np.ma.MaskedArray(rstd, mask=invalid)
+    res.cov = np.ma.MaskedArray(cov, mask=invalid)
+    res.Rratio = np.ma.MaskedArray(rratio, mask=invalid)
+    res.MUratio = np.ma.MaskedArray(muratio, mask=invalid)
+    res.Rdifflinearity = np.ma.MaskedArray(rdiff, mask=invalid)
+    res.slope = a
+    res.slope_err = a_err
+    res.prn = chi_statistic(mu_f, rmean, valid, a, np.zeros_like(a))
+    res.analysed = valid.sum(axis=1) >= 2
+    return res
+
+
+def parse_readings(strings, n_repeats=None):
+    '''Parse stored R strings such as "[1.0, 2.0, 3.0]" into a masked (rows, repeats) array'''
+    text = [str(s).strip('[] ') for s in strings]
+    counts = np.array([t.count(',')+1 if t else 0 for t in text], dtype=int)
+    total = counts.sum()
+    width = int(counts.max(initial=0)) if n_repeats is None else n_repeats
+    data = np.zeros((len(text), width))
+    mask = np.ones(data.shape, dtype=bool)
+    if total:
+        values = np.array(','.join(t for t in text if t).split(','), dtype=float)
+        rows = np.repeat(np.arange(len(text)), counts)
+        cols = np.arange(total) - np.repeat(np.cumsum(counts)-counts, counts)
+        data[rows, cols] = values
+        mask[rows, cols] = False
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def history_arrays(chunks):
+    '''
+        Stream (ADate, MachineName, Chamber, Energy, MUindex, MU, R) row chunks, grouped by ADate,
+        into session metadata and (sessions x MU levels x repeats) readings, oldest session first.
+        Returns (sessions, readings, mu) where sessions is a dict of per-session arrays.
+    '''
+    adate, machine, chamber, energy, muindex, mu, readings = [], [], [], [], [], [], []
+    for rows in chunks:
+        cols = list(zip(*rows))
+        adate.append(np.array(cols[0], dtype=object))
+        machine.append(np.array(cols[1], dtype=object))
+        chamber.append(np.array(cols[2], dtype=object))
+        energy.append(np.array(cols[3], dtype=float))
+        muindex.append(np.array(cols[4], dtype=int))
+        mu.append(np.array(cols[5], dtype=float))
+        readings.append(parse_readings(cols[6]))
+    if not adate:
+        empty = np.empty(0, dtype=object)
+        sessions = {'ADate': empty, 'MachineName': empty, 'Chamber': empty, 'Energy': np.empty(0)}
+        return sessions, np.ma.zeros((0, 0, 0)), np.ma.zeros((0, 0))
+
+    adate = np.concatenate(adate)
+    muindex = np.concatenate(muindex)-1
+    width = max(r.shape[1] for r in readings)
+    r = np.ma.concatenate([np.ma.MaskedArray(
+        np.pad(x.data, ((0, 0), (0, width-x.shape[1]))),
+        mask=np.pad(np.ma.getmaskarray(x), ((0, 0), (0, width-x.shape[1])), constant_values=True))
+        for x in readings])
+
+    # rows are grouped by ADate so a new session starts wherever ADate changes
+    new = np.r_[True, adate[1:] != adate[:-1]]
+    sidx = np.cumsum(new)-1
+    first = np.flatnonzero(new)
+    n_sessions, n_mu = first.size, muindex.max()+1
+
+    data = np.zeros((n_sessions, n_mu, width))
+    mask = np.ones(data.shape, dtype=bool)
+    data[sidx, muindex] = r.data
+    mask[sidx, muindex] = np.ma.getmaskarray(r)
+    mu_data = np.zeros((n_sessions, n_mu))
+    mu_mask = np.ones(mu_data.shape, dtype=bool)
+    mu_data[sidx, muindex] = np.concatenate(mu)
+    mu_mask[sidx, muindex] = False
+
+    # text dates (dd/mm/YYYY) do not sort chronologically, so order sessions by the parsed time
+    order = np.argsort(session_times(adate[first]), kind='stable')
+    first = first[order]
+    sessions = {
+        'ADate': adate[first],
+        'MachineName': np.concatenate(machine)[first],
+        'Chamber': np.concatenate(chamber)[first],
+        'Energy': np.concatenate(energy)[first],
+    }
+    return sessions, np.ma.MaskedArray(data, mask=mask)[order], np.ma.MaskedArray(mu_data, mask=mu_mask)[order]
+
+
+def session_times(adate):
+    '''ADate strings or datetimes as datetime64; unreadable dates are NaT and sort last'''
+    times = []
+    for a in adate:
+        try:
+            if not isinstance(a, datetime.datetime):
+                a = datetime.datetime.strptime(str(a).strip(), ADATE_FORMAT)
+            times.append(np.datetime64(a.replace(microsecond=0, tzinfo=None), 's'))
+        except ValueError:
+            times.append(np.datetime64('NaT', 's'))
+    return np.array(times, dtype='datetime64[s]')
+
+
+def history_trends(chunks):
+    '''Per-session linearity deviation, CoV and chi trends from streamed history rows'''
+    sessions, readings, mu = history_arrays(chunks)
+    trends = dict(sessions)
+    if not readings.size:
+        for k in ['deviation', 'cov', 'prn', 'slope']:
+            trends[k] = np.empty(0)
+        trends['analysed'] = np.empty(0, dtype=bool)
+        return trends
+    res = analyse(readings, mu)
+    trends['deviation'] = np.abs(res.Rdifflinearity).max(axis=1).filled(np.nan)
+    trends['cov'] = np.abs(res.cov).max(axis=1).filled(np.nan)
+    trends['prn'] = res.prn
+    trends['slope'] = res.slope
+    trends['analysed'] = res.analysed
+    return trends
+
+
+class LiveStats:
+    '''Running mean/variance per MU level, updated one reading at a time as values are typed'''
+    def __init__(self, n_mu, n_repeats):
+        self.values = np.full((n_mu, n_repeats), np.nan)
+        self.MU = np.full(n_mu, np.nan)
+        self.n = np.zeros(n_mu, dtype=int)
+        self.mean = np.zeros(n_mu)
+        self.m2 = np.zeros(n_mu) # sum of squared deviations from the mean
+
+    def _add(self, i, x):
+        self.n[i] += 1
+        d = x - self.mean[i]
+        self.mean[i] += d/self.n[i]
+        self.m2[i] += d*(x - self.mean[i])
+
+    def _remove(self, i, x):
+        if self.n[i] <= 1:
+            self.n[i], self.mean[i], self.m2[i] = 0, 0., 0.
+            return
+        mean = (self.n[i]*self.mean[i] - x)/(self.n[i]-1)
+        self.m2[i] = max(0., self.m2[i] - (x - mean)*(x - self.mean[i]))
+        self.mean[i] = mean
+        self.n[i] -= 1
+
+    @staticmethod
+    def _parse(value):
+        '''Float from a field value, None if blank; ValueError for text, nan or inf'''
+        if value is None or value == '':
+            return None
+        x = float(value)
+        if not np.isfinite(x):
+            raise ValueError("not a finite number: "+str(value))
+        return x
+
+    def set_reading(self, i, k, value):
+        '''Set (or clear with None/'') reading k of MU level i; only that level is updated'''
+        x = self._parse(value)
+        old = self.values[i, k]
+        if not np.isnan(old):
+            self._remove(i, old)
+        if x is None:
+            self.values[i, k] = np.nan
+        else:
+            self.values[i, k] = x
+            self._add(i, x)
+
+    def set_mu(self, i, value):
+        x = self._parse(value)
+        self.MU[i] = np.nan if x is None else x
+
+    def row(self, i):
+        '''(mean, cov %) of MU level i, or (None, None) if it has no readings'''
+        if self.n[i] == 0:
+            return None, None
+        mean = self.mean[i]
+        return mean, np.sqrt(self.m2[i]/self.n[i])/mean*100
+
+    def valid(self):
+        return (self.n > 0) & ~np.isnan(self.MU)
+
+    def chi(self):
+        '''Chi statistic from the running means, or None if fewer than two MU levels are measured'''
+        valid = self.valid()[None]
+        if valid.sum() < 2:
+            return None
+        mu, rmean = self.MU[None], self.mean[None]
+        a, _ = fit_origin(mu, rmean, valid)
+        return chi_statistic(mu, rmean, valid, a, np.zeros_like(a))[0]
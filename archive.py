@@ -0,0 +1,142 @@
+"""
+Consolidated result archive
+Sessions and results from every export are appended to one SQLite file
+instead of a new csv folder each time. Both tables are clustered on
+(MachineName, Year, ATime) so loading a gantry's history only reads that
+gantry's partition; sessions are also indexed on ADate, Chamber and Energy.
+"""
+
+import datetime
+import os
+import sqlite3
+
+import database_df as db
+
+ARCHIVE_PATH = os.path.join(os.path.expanduser('~'), '.doselinearity', 'archive.sqlite')
+ADATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+PARTITION = ['MachineName', 'Year', 'ATime'] # leading primary key columns of both tables
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sessions (
+        MachineName TEXT NOT NULL, Year INTEGER NOT NULL, ATime TEXT NOT NULL, ADate TEXT NOT NULL,
+        "Operator 1" TEXT, "Operator 2" TEXT, GA REAL, Energy REAL, Electrometer TEXT, Voltage REAL,
+        ChamberType TEXT, Chamber TEXT, Temperature REAL, Pressure REAL, LinearityPass TEXT,
+        RepeatabilityPass TEXT, Comments TEXT,
+        PRIMARY KEY (MachineName, Year, ATime)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS results (
+        MachineName TEXT NOT NULL, Year INTEGER NOT NULL, ATime TEXT NOT NULL, MUindex INTEGER NOT NULL,
+        RTimestamp TEXT, ADate TEXT NOT NULL, MU REAL, Rmean REAL, Rdifflinearity REAL, Rstd REAL,
+        Rratio REAL, MUratio REAL, R TEXT, VarPass TEXT,
+        PRIMARY KEY (MachineName, Year, ATime, MUindex)) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS sessions_adate ON sessions (ADate)',
+    'CREATE INDEX IF NOT EXISTS sessions_chamber ON sessions (Chamber, MachineName)',
+    'CREATE INDEX IF NOT EXISTS sessions_energy ON sessions (Energy, MachineName)',
+]
+
+
+def atime(adate):
+    '''Sortable ISO time for an ADate string or datetime'''
+    if not isinstance(adate, datetime.datetime):
+        adate = datetime.datetime.strptime(str(adate).strip(), ADATE_FORMAT)
+    return adate.replace(microsecond=0).isoformat()
+
+
+def _quote(col):
+    return '"'+col+'"'
+
+
+class Archive():
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as conn:
+            for sql in SCHEMA:
+                conn.execute(sql)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def append(self, df_session, df_results):
+        '''Append sessions and their results in one transaction; return False if any session is already archived'''
+        session_cols = PARTITION+[c for c in db.SESSION_COLUMNS if c != 'MachineName']
+        results_cols = PARTITION+[c for c in db.RESULTS_COLUMNS if c != 'MUindex']+['MUindex']
+        partition = {}
+        sessions = []
+        for row in zip(*[df_session[c].tolist() for c in db.SESSION_COLUMNS]):
+            rec = dict(zip(db.SESSION_COLUMNS, row))
+            t = atime(rec['ADate'])
+            partition[rec['ADate']] = (rec['MachineName'], int(t[:4]), t)
+            sessions.append(partition[rec['ADate']]+tuple(rec[c] for c in session_cols[3:]))
+        results = []
+        for row in zip(*[df_results[c].tolist() for c in db.RESULTS_COLUMNS]):
+            rec = dict(zip(db.RESULTS_COLUMNS, row))
+            rec['MUindex'] = int(rec['MUindex'])
+            rec['R'] = str(rec['R'])
+            results.append(partition[rec['ADate']]+tuple(rec[c] for c in results_cols[3:]))
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT INTO sessions (%s) VALUES (%s)' % (
+                    ','.join(map(_quote, session_cols)), ','.join('?'*len(session_cols))), sessions)
+                conn.executemany('INSERT INTO results (%s) VALUES (%s)' % (
+                    ','.join(map(_quote, results_cols)), ','.join('?'*len(results_cols))), results)
+        except sqlite3.IntegrityError:
+            print("Session already archived, nothing written: "+self.path)
+            return False
+        finally:
+            conn.close()
+        print("Archived %d sessions to %s" % (len(sessions), self.path))
+        return True
+
+    def existing(self):
+        '''Set of archived session ADates'''
+        with self._connect() as conn:
+            return set(row[0] for row in conn.execute('SELECT ADate FROM sessions'))
+
+    def machines(self):
+        '''Gantries with archived sessions'''
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute('SELECT DISTINCT MachineName FROM sessions ORDER BY MachineName')]
+
+    def _where(self, machine, chamber=None, energy_min=None, energy_max=None, year_min=None, year_max=None):
+        sql = ' WHERE s.MachineName = ?'
+        params = [machine]
+        for clause, value in [(' AND s.Year >= ?', year_min), (' AND s.Year <= ?', year_max),
+                              (' AND s.Chamber = ?', chamber),
+                              (' AND s.Energy >= ?', energy_min), (' AND s.Energy <= ?', energy_max)]:
+            if value is not None:
+                sql += clause
+                params.append(value)
+        return sql, params
+
+    def sessions(self, machine, chamber=None, energy_min=None, energy_max=None, year_min=None, year_max=None):
+        '''Archived sessions for a gantry as a dataframe, oldest first'''
+        import pandas as pd
+        where, params = self._where(machine, chamber, energy_min, energy_max, year_min, year_max)
+        sql = 'SELECT %s FROM sessions AS s' % ','.join('s.'+_quote(c) for c in db.SESSION_COLUMNS)
+        with self._connect() as conn:
+            return pd.read_sql_query(sql+where+' ORDER BY s.ATime', conn, params=params)
+
+    def history(self, machine, chamber=None, energy_min=None, energy_max=None, year_min=None, year_max=None,
+                chunk_size=1000):
+        '''
+            Stream (ADate, MachineName, Chamber, Energy, MUindex, MU, R) rows in chunks,
+            as database_df.query_history, reading only the gantry's partition.
+        '''
+        where, params = self._where(machine, chamber, energy_min, energy_max, year_min, year_max)
+        sql = '''
+                SELECT s.ADate, s.MachineName, s.Chamber, s.Energy, r.MUindex, r.MU, r.R
+                FROM sessions AS s INNER JOIN results AS r
+                ON r.MachineName = s.MachineName AND r.Year = s.Year AND r.ATime = s.ATime
+            '''+where+' ORDER BY s.ATime, r.MUindex'
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
@@ -0,0 +1,188 @@
+"""
+Performance benchmarks for DoseLinearity
+Covers startup, analysis, fitting, dataframe conversion, csv export, field
+checking and the results write path (against the SQLite backend, so no
+Access driver is needed). Each benchmark is parameterised by the number of
+MU levels, repeats and sessions. Timings are compared with a saved baseline
+and the script exits with a non-zero status if anything regresses.
+
+usage: python benchmark.py [--save] [--tolerance 1.5] [--mu 5 20] [--repeats 3 10] [--sessions 1 100]
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, 'benchmark_baseline.json')
+TOLERANCE = 1.5 # fail if slower than baseline x tolerance
+IMPORT_BUDGET = 2.0 # seconds; main must always import faster than this
+LAZY_MODULES = ['pandas', 'matplotlib', 'pypyodbc'] # must not be loaded by importing main
+REPEATS = 5 # timing runs per benchmark; the best is kept
+MU_LEVELS = [5, 20]
+READING_REPEATS = [3, 10]
+SESSIONS = [1, 100]
+SEED = 1234
+
+
+def bench_import(module='main', repeats=5):
+    '''Best-of-n cold import time of module in a fresh interpreter, and any lazy modules it loaded'''
+    code = ("import sys,time;t=time.perf_counter();import %s;print(time.perf_counter()-t);"
+            "print(','.join(m for m in %r if m in sys.modules))") % (module, LAZY_MODULES)
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True, check=True)
+        t, loaded = out.stdout.splitlines()[-2:]
+        times.append(float(t))
+    return min(times), [m for m in loaded.split(',') if m]
+
+
+def best_of(fn, setup=None, repeats=REPEATS):
+    '''Best wall time of fn() over repeats; setup() runs untimed before each call'''
+    best = float('inf')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            if setup:
+                setup()
+            t = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter()-t)
+    return best
+
+
+def make_sessions(n_mu, n_rep, n_sessions, seed=SEED):
+    '''Reproducible readings as GUI-style lists: ([session][MU][repeat], [MU])'''
+    rng = np.random.default_rng(seed)
+    mu = np.linspace(5, 5*n_mu, n_mu)
+    r = mu[None, :, None]*0.2*(1 + 0.002*rng.standard_normal((n_sessions, n_mu, n_rep)))
+    return r.tolist(), mu.tolist()
+
+
+def make_values(rlist, mulist):
+    '''GUI values dict for field_check.check'''
+    import grid
+    values = {'ADate': '01/06/2024 10:00:00', '-Op1-': 'AB', '-Op2-': '', 'Temp': '20.5', 'Press': '1010',
+              '-G-': 'Gantry 1', 'GA': '0', 'EN': '160', '-Chtype-': 'Roos', '-Ch-': '003126',
+              '-El-': '92579', '-V-': '-400'}
+    for i in range(len(mulist)):
+        values[grid.mu_key(i)] = str(mulist[i])
+        for k in range(len(rlist[i])):
+            values[grid.reading_key(i, k)] = str(rlist[i][k])
+    return values
+
+
+def bench_case(n_mu, n_rep, n_sessions):
+    '''Time every hot path for one grid size; return {name: seconds}'''
+    import pandas as pd
+    import analysis as an
+    import database_df as db
+    import field_check as fc
+    import main
+
+    tag = '[mu=%d,rep=%d,sessions=%d]' % (n_mu, n_rep, n_sessions)
+    rlists, mulist = make_sessions(n_mu, n_rep, n_sessions)
+    timings = {}
+
+    # per-session GUI analysis path, and the same sessions in one vectorised call
+    results = [main.DLresults() for _ in rlists]
+    def analyse_each():
+        for res, rlist in zip(results, rlists):
+            res.__init__()
+            res.analysis(rlist, mulist)
+            res.assign_session('01/06/2024 10:00:00')
+    timings['DLresults.analysis'+tag] = best_of(analyse_each)
+    timings['analysis.analyse'+tag] = best_of(lambda: an.analyse(an.readings_array(rlists), np.array(mulist)))
+    timings['fit_data'+tag] = best_of(lambda: [res.fit_data() for res in results])
+    def fit_prn():
+        for res in results:
+            a, b = res._fit()
+            res._prn(res.MU, res.Rmean, a, 0)
+    timings['_fit+_prn'+tag] = best_of(fit_prn)
+
+    # dataframe conversion and csv export
+    for res in results:
+        res.VarPass[:] = 'PASS'
+    keys = db.RESULTS_COLUMNS
+    timings['convert2df'+tag] = best_of(lambda: [main.convert2df(res, keys) for res in results])
+    with tempfile.TemporaryDirectory() as tmp:
+        timings['export_csv'+tag] = best_of(lambda: [main.export_csv(data=res, keys=keys, dname=tmp) for res in results])
+
+    # field checks on the GUI values
+    check = fc.field_check(['AB'], ['Gantry 1'], ['003126'], ['92579'], ['-400'], n_mu, n_rep)
+    values = [make_values(rlist, mulist) for rlist in rlists]
+    timings['field_check.check'+tag] = best_of(lambda: [check.check(v) for v in values])
+
+    # results write path against an in-memory SQLite backend
+    df_results = pd.concat([main.convert2df(res, keys) for res in results], ignore_index=True)
+    df_results['RTimestamp'] = [str(i) for i in range(len(df_results))]
+    backend = db.SQLiteBackend()
+    conn = backend.pool.get()
+    def clear():
+        conn.execute('DELETE FROM "%s"' % db.RESULTS_TABLE)
+        conn.commit()
+    def write():
+        backend.write_results(conn, df_results, popup=False)
+        conn.commit()
+    timings['write_results_data'+tag] = best_of(write, setup=clear)
+    backend.close()
+    return timings
+
+
+def compare(timings, baseline, tolerance):
+    '''Return a list of regressions against the baseline'''
+    failed = []
+    for name, t in timings.items():
+        if name in baseline and t > baseline[name]*tolerance:
+            failed.append('%s: %.4f s vs baseline %.4f s' % (name, t, baseline[name]))
+    return failed
+
+
+def run(save=False, tolerance=TOLERANCE, mu_levels=MU_LEVELS, repeats=READING_REPEATS, sessions=SESSIONS):
+    timings = {}
+    failed = []
+
+    for n_mu, n_rep, n_sessions in itertools.product(mu_levels, repeats, sessions):
+        timings.update(bench_case(n_mu, n_rep, n_sessions))
+
+    t, loaded = bench_import('main')
+    timings['import_main'] = t
+    if t > IMPORT_BUDGET:
+        failed.append('import_main: %.3f s exceeds budget of %.1f s' % (t, IMPORT_BUDGET))
+    if loaded:
+        failed.append('import_main loaded: '+', '.join(loaded))
+
+    for name, t in timings.items():
+        print('%-60s %10.4f s' % (name, t))
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    failed += compare(timings, baseline, tolerance)
+
+    if save:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(timings, f, indent=2)
+        print("Saved: "+BASELINE_PATH)
+    for msg in failed:
+        print('REGRESSION '+msg)
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DoseLinearity performance benchmarks')
+    parser.add_argument('--save', action='store_true', help='save timings as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown factor')
+    parser.add_argument('--mu', type=int, nargs='+', default=MU_LEVELS, help='numbers of MU levels')
+    parser.add_argument('--repeats', type=int, nargs='+', default=READING_REPEATS, help='readings per MU level')
+    parser.add_argument('--sessions', type=int, nargs='+', default=SESSIONS, help='numbers of sessions')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.save, args.tolerance, args.mu, args.repeats, args.sessions) else 1)
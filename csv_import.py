@@ -0,0 +1,271 @@
+"""
+Bulk import of exported session.csv/results.csv folders
+Walks a directory tree, validates and re-analyses every exported session
+and writes sessions not already in the database (or the consolidated
+archive with --archive) in batched transactions.
+
+usage: python csv_import.py FOLDER [--db PATH | --sqlite PATH | --archive PATH] [--workers N] [--batch N] [--dry-run] [--report CSV]
+"""
+
+import argparse
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import analysis as an
+import archive as ar
+import database_df as db
+import field_check as fc
+
+ADATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+BATCH_SIZE = 50 # sessions per database transaction
+SESSION_FILE = 'session.csv'
+RESULTS_FILE = 'results.csv'
+RESULTS_FLOATS = ['MU', 'Rmean', 'Rdifflinearity', 'Rstd', 'Rratio', 'MUratio']
+# session fields checked against the GUI schema; dropdown lists are not known offline
+SESSION_VALIDATOR = fc.Validator(fc.SCHEMA, names=fc.COLUMNS)
+
+
+def adate_key(adate):
+    '''Comparable key for an ADate read from csv (string) or the database (datetime or string)'''
+    if isinstance(adate, datetime.datetime):
+        return adate.replace(microsecond=0)
+    return datetime.datetime.strptime(str(adate).strip(), ADATE_FORMAT)
+
+
+def find_exports(root):
+    '''Yield every folder under root containing an exported session or results csv'''
+    for dirpath, _, files in os.walk(root):
+        if SESSION_FILE in files or RESULTS_FILE in files:
+            yield dirpath
+
+
+def read_export(folder):
+    '''Read the csv files in an export folder; return (folder, df_session, df_results, error)'''
+    df_session = df_results = None
+    try:
+        fname = os.path.join(folder, SESSION_FILE)
+        if os.path.exists(fname):
+            df_session = pd.read_csv(fname, dtype=str, keep_default_na=False)
+            missing = set(db.SESSION_COLUMNS) - set(df_session.columns)
+            if missing:
+                return folder, None, None, SESSION_FILE+' missing columns: '+', '.join(sorted(missing))
+            df_session = df_session[db.SESSION_COLUMNS]
+        fname = os.path.join(folder, RESULTS_FILE)
+        if os.path.exists(fname):
+            df_results = pd.read_csv(fname, dtype=str, keep_default_na=False)
+            missing = set(db.RESULTS_COLUMNS) - set(df_results.columns)
+            if missing:
+                return folder, None, None, RESULTS_FILE+' missing columns: '+', '.join(sorted(missing))
+            df_results = df_results[db.RESULTS_COLUMNS]
+            df_results[RESULTS_FLOATS] = df_results[RESULTS_FLOATS].apply(pd.to_numeric)
+    except Exception as e:
+        return folder, None, None, str(e)
+    return folder, df_session, df_results, None
+
+
+def validate(df_session, df_results):
+    '''Return an error message for an invalid session/results pair, or None'''
+    violations = SESSION_VALIDATOR.validate_batch(df_session)
+    if violations:
+        return '; '.join(v.message for v in violations)
+    if len(df_results) < 2:
+        return 'fewer than two MU levels'
+    if df_results['MU'].isna().any() or (df_results['R'] == '').any():
+        return 'missing MU or readings'
+    try:
+        muindex = df_results['MUindex'].astype(int)
+    except (TypeError, ValueError):
+        return 'MUindex must be a whole number'
+    if (muindex < 1).any() or muindex.duplicated().any():
+        return 'MUindex must be unique and start at 1'
+    try:
+        an.parse_readings(df_results['R'])
+    except ValueError:
+        return 'unreadable readings in R'
+    return None
+
+
+def reanalyse(df_results):
+    '''Recompute derived results columns for a batch of sessions in one vectorised call'''
+    sidx, _ = pd.factorize(df_results['ADate'])
+    lidx = df_results['MUindex'].astype(int).to_numpy()-1
+    r = an.parse_readings(df_results['R'])
+    readings = np.ma.MaskedArray(np.zeros((sidx.max()+1, lidx.max()+1, r.shape[1])), mask=True)
+    mu = np.ma.MaskedArray(np.zeros(readings.shape[:2]), mask=True)
+    readings[sidx, lidx] = r
+    mu[sidx, lidx] = df_results['MU'].to_numpy()
+    res = an.analyse(readings, mu)
+    df_results = df_results.copy()
+    for col in ['Rmean', 'Rstd', 'Rratio', 'MUratio', 'Rdifflinearity']:
+        df_results[col] = getattr(res, col)[sidx, lidx].filled(np.nan)
+    return df_results
+
+
+class Importer():
+    def __init__(self, batch_size=BATCH_SIZE, dry_run=False, archive=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.archive = archive
+        self.existing = set()
+        self.sessions = {} # adate key -> (folder, df_session)
+        self.results = {} # adate key -> (folder, df_results)
+        self.batch = [] # [(folders, df_session, df_results)]
+        self.report = [] # (folder, ADate, status, message)
+        self.counts = {'written': 0, 'skipped': 0, 'invalid': 0, 'failed': 0}
+        self.rows = 0
+
+    def _record(self, folders, adate, status, msg=''):
+        for folder in folders:
+            self.report.append((folder, adate, status, msg))
+        if status in self.counts:
+            self.counts[status] += 1
+
+    def add(self, folder, df_session, df_results, error):
+        '''Pair up csv files by ADate and queue complete sessions'''
+        if error:
+            self._record([folder], '', 'invalid', error)
+            return
+        if df_session is not None:
+            for _, row in df_session.iterrows():
+                self._pair(folder, row['ADate'], session=row.to_frame().T)
+        if df_results is not None:
+            for adate, df in df_results.groupby('ADate', sort=False):
+                self._pair(folder, adate, results=df)
+
+    def _pair(self, folder, adate, session=None, results=None):
+        try:
+            key = adate_key(adate)
+        except ValueError:
+            self._record([folder], adate, 'invalid', 'invalid ADate: '+adate)
+            return
+        if session is not None:
+            self.sessions[key] = (folder, session)
+        if results is not None:
+            self.results[key] = (folder, results)
+        if key in self.sessions and key in self.results:
+            s_folder, df_session = self.sessions.pop(key)
+            r_folder, df_results = self.results.pop(key)
+            folders = sorted(set([s_folder, r_folder]))
+            if key in self.existing:
+                self._record(folders, adate, 'skipped', 'already in database')
+                return
+            msg = validate(df_session, df_results)
+            if msg:
+                self._record(folders, adate, 'invalid', msg)
+                return
+            self.existing.add(key)
+            self.batch.append((folders, df_session, df_results))
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def _write(self, batch):
+        df_session = pd.concat([b[1] for b in batch], ignore_index=True)
+        df_results = reanalyse(pd.concat([b[2] for b in batch], ignore_index=True))
+        if self.dry_run:
+            return True
+        if self.archive:
+            return self.archive.append(df_session, df_results)
+        return db.write_to_db(df_session, df_results, popup=False)
+
+    def flush(self):
+        '''Write queued sessions in one transaction; isolate failures by writing singly'''
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        try:
+            ok = self._write(batch)
+        except Exception as e:
+            print("Batch write failed, writing sessions singly: "+str(e))
+            ok = False
+        if ok:
+            done = batch
+        else:
+            done = []
+            for item in batch:
+                adate = item[1]['ADate'].iloc[0]
+                try:
+                    reanalyse(item[2])
+                except Exception as e:
+                    self._record(item[0], adate, 'invalid', 'cannot analyse: '+str(e))
+                    continue
+                try:
+                    if self._write([item]):
+                        done.append(item)
+                    else:
+                        self._record(item[0], adate, 'failed', 'database write failed')
+                except Exception as e:
+                    self._record(item[0], adate, 'failed', 'database write failed: '+str(e))
+        for folders, df_session, df_results in done:
+            self._record(folders, df_session['ADate'].iloc[0], 'written', 'dry run' if self.dry_run else '')
+            self.rows += len(df_results)
+
+    def finish(self):
+        '''Write the final batch and report unpaired files'''
+        self.flush()
+        for key, (folder, df) in self.sessions.items():
+            self._record([folder], df['ADate'].iloc[0], 'invalid', 'no matching '+RESULTS_FILE)
+        for key, (folder, df) in self.results.items():
+            self._record([folder], df['ADate'].iloc[0], 'invalid', 'no matching '+SESSION_FILE)
+        self.sessions, self.results = {}, {}
+
+
+def ingest(root, workers=None, batch_size=BATCH_SIZE, dry_run=False, archive=None):
+    '''Import every exported session under root; return the Importer holding the per-file report'''
+    t0 = time.perf_counter()
+    importer = Importer(batch_size, dry_run, archive)
+    existing = archive.existing() if archive else db.existing_sessions()
+    if existing is None and not dry_run:
+        raise RuntimeError("Cannot read existing sessions from the database")
+    for adate in existing or []:
+        try:
+            importer.existing.add(adate_key(adate))
+        except ValueError:
+            pass
+
+    folders = list(find_exports(root))
+    print("Found %d export folders under %s" % (len(folders), root))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for loaded in pool.map(read_export, folders, chunksize=16):
+            importer.add(*loaded)
+    importer.finish()
+
+    elapsed = time.perf_counter()-t0
+    sessions = sum(importer.counts.values())
+    print("%d sessions in %.1f s (%.1f sessions/s, %.0f result rows/s)" % (
+        sessions, elapsed, sessions/elapsed if elapsed else 0, importer.rows/elapsed if elapsed else 0))
+    print(', '.join('%s: %d' % (k, v) for k, v in importer.counts.items()))
+    return importer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import exported dose linearity csv folders')
+    parser.add_argument('folder', help='root folder of csv exports')
+    parser.add_argument('--db', help='path to the Access database')
+    parser.add_argument('--password', help='database password')
+    parser.add_argument('--sqlite', help='import into this SQLite file instead of the Access database')
+    parser.add_argument('--archive', help='append to this consolidated archive instead of the database')
+    parser.add_argument('--workers', type=int, default=None, help='parallel csv readers')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='sessions per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='validate and analyse without writing')
+    parser.add_argument('--report', help='write the per-file results to this csv')
+    args = parser.parse_args()
+    if args.db:
+        db.DB_PATH = args.db
+    if args.password:
+        db.PASSWORD = args.password
+    if args.sqlite:
+        db.set_backend(db.SQLiteBackend(args.sqlite))
+
+    archive = ar.Archive(args.archive) if args.archive else None
+    importer = ingest(args.folder, args.workers, args.batch, args.dry_run, archive)
+    report = pd.DataFrame(importer.report, columns=['Folder', 'ADate', 'Status', 'Message'])
+    if args.report:
+        report.to_csv(args.report, index=False)
+        print("Saved: "+args.report)
+    else:
+        print(report.to_string(index=False))
@@ -5,20 +5,484 @@ Adapted and extended from script by Steven Court
 Interaction with QA database
 """
 
+import atexit
 import string
-import PySimpleGUI as sg
-import pypyodbc
-from pypyodbc import IntegrityError
-import pandas as pd
+import threading
+import time
+
+import perf
+import refcache as rc
+
+# pypyodbc and PySimpleGUI are imported on first use so headless tools start quickly
 
 SESSION_TABLE = "DoseLinearitySession"
 RESULTS_TABLE = "DoseLinearityResults"
+SESSION_COLUMNS = ['ADate', 'Operator 1', 'Operator 2', 'MachineName', 'GA', 'Energy', 'Electrometer', 'Voltage',
+    'ChamberType', 'Chamber', 'Temperature', 'Pressure', 'LinearityPass', 'RepeatabilityPass', 'Comments']
+RESULTS_COLUMNS = ['RTimestamp', 'ADate', 'MUindex', 'MU', 'Rmean', 'Rdifflinearity', 'Rstd', 'Rratio',
+    'MUratio', 'R', 'VarPass']
 DB_PATH = None
 PASSWORD = None
+HEALTH_CHECK_INTERVAL = 30 # seconds idle before a pooled connection is checked
+
+
+def _popup(*args):
+    import PySimpleGUI as sg
+    sg.popup(*args)
+
+def _connection_string():
+    if PASSWORD:
+        return 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD)
+    else:
+        return 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)
+
+
+class ConnectionManager():
+    '''Open the database connection once and reuse it for reads and writes'''
+    def __init__(self, connect):
+        self.connect = connect
+        self.conn = None
+        self.last_used = 0
+        self.statements = {} # sql -> cursor holding the prepared statement
+        self.lock = threading.RLock()
+
+    def _open(self):
+        print("Opening database connection...")
+        with perf.span('connection_open'):
+            self.conn = self.connect()
+
+    def _healthy(self):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def get(self):
+        '''Return an open connection, reconnecting a stale handle if needed'''
+        with self.lock:
+            if self.conn is None:
+                self._open()
+            elif time.time()-self.last_used > HEALTH_CHECK_INTERVAL and not self._healthy():
+                print("Stale database connection, reconnecting...")
+                self.reconnect()
+            self.last_used = time.time()
+            return self.conn
+
+    def cursor(self, sql):
+        '''Cursor for sql, reused so the statement is only prepared once per connection'''
+        with self.lock:
+            conn = self.get()
+            if sql not in self.statements:
+                self.statements[sql] = conn.cursor()
+            return self.statements[sql]
+
+    def reconnect(self):
+        with self.lock:
+            self.close()
+            self._open()
+            return self.conn
+
+    def close(self):
+        with self.lock:
+            for cursor in self.statements.values():
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+            self.statements = {}
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+
+
+# ADate is dd/mm/YYYY text in SQLite, so sessions are ordered by this ISO time derived from it
+SQLITE_ATIME = '''GENERATED ALWAYS AS (substr(ADate,7,4)||'-'||substr(ADate,4,2)||'-'||substr(ADate,1,2)||'T'||
+        substr(ADate,12)) VIRTUAL'''
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS Operators (Initials TEXT PRIMARY KEY)''',
+    '''CREATE TABLE IF NOT EXISTS Assets (Model TEXT, [Serial Number] TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS "%s" (ADate TEXT PRIMARY KEY, [Operator 1] TEXT, [Operator 2] TEXT,
+        MachineName TEXT, GA REAL, Energy REAL, Electrometer TEXT, Voltage REAL, ChamberType TEXT, Chamber TEXT,
+        Temperature REAL, Pressure REAL, LinearityPass TEXT, RepeatabilityPass TEXT, Comments TEXT,
+        ATime TEXT %s)'''%(SESSION_TABLE, SQLITE_ATIME),
+    '''CREATE TABLE IF NOT EXISTS "%s" (RTimestamp TEXT PRIMARY KEY, ADate TEXT, MUindex TEXT, MU REAL,
+        Rmean REAL, Rdifflinearity REAL, Rstd REAL, Rratio REAL, MUratio REAL, R TEXT, VarPass TEXT)'''%(RESULTS_TABLE),
+    '''CREATE INDEX IF NOT EXISTS ResultsADate ON "%s" (ADate)'''%(RESULTS_TABLE),
+    '''CREATE INDEX IF NOT EXISTS SessionMachineATime ON "%s" (MachineName, ATime)'''%(SESSION_TABLE),
+]
+
+
+class Backend():
+    '''
+        Database backend interface: read_lookup, write_session, write_results and
+        query_history over a pooled connection with cached prepared statements.
+        Subclasses provide connect() and ready().
+    '''
+    ORDER_BY = 's.ADate' # sortable session time column; ADate is a Date/Time field in Access
+
+    def __init__(self):
+        self.pool = ConnectionManager(self.connect)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def ready(self):
+        '''True if the backend is configured well enough to try connecting'''
+        raise NotImplementedError
+
+    def close(self):
+        self.pool.close()
+
+    def ping(self):
+        '''True if the pooled connection answers SELECT 1'''
+        if not self.ready():
+            return False
+        with self.pool.lock:
+            try:
+                self.pool.get()
+            except Exception:
+                return False
+            return self.pool._healthy()
+
+    def integrity_error(self, conn):
+        '''IntegrityError class of the driver behind conn (DB-API connection attribute where provided)'''
+        error = getattr(conn, 'IntegrityError', None)
+        if error is None:
+            from pypyodbc import IntegrityError as error
+        return error
+
+    def query(self, sql, params, table, popup=True):
+        '''Run a parameterised query on the pooled connection; return all rows or None'''
+        if not self.ready():
+            if popup:
+                _popup("Path Error.","Provide a path to the Access Database.")
+            print("Database Path Missing!")
+            return None
+        with self.pool.lock:
+            try:
+                cursor = self.pool.cursor(sql)
+            except Exception:
+                if popup:
+                    _popup("WARNING","Could not connect to database")
+                print("Connection to table "+table+" failed...")
+                return None
+            try:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+            except Exception as e:
+                error = e
+            if self.pool._healthy():
+                # connection is fine, so the query itself is bad (e.g. unknown table)
+                if popup:
+                    _popup("WARNING","Could not read table "+table)
+                print("Query on table "+table+" failed: "+str(error))
+                return None
+            # handle dropped since the last health check, retry once
+            try:
+                self.pool.reconnect()
+                cursor = self.pool.cursor(sql)
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+            except Exception as e:
+                if popup:
+                    _popup("WARNING","Could not connect to database")
+                print("Connection to table "+table+" failed: "+str(e))
+                return None
+
+    def read_lookup(self, table, target, filter_var=None, filter_vals=None, popup=True):
+        '''
+            Return target values from table as a list, or as {filter value: [target, ...]}
+            for several filter values fetched in one query. None if the query fails.
+        '''
+        if filter_var:
+            sql = '''
+                    SELECT %s, %s FROM %s WHERE %s IN (%s)
+                '''%(filter_var, target, table, filter_var, ','.join(['?']*len(filter_vals)))
+            with perf.span('read_db_data', table=table):
+                records = self.query(sql, list(filter_vals), table, popup)
+            if records is None:
+                return None
+            data = {v: [] for v in filter_vals}
+            for key, value in records:
+                data.setdefault(key, []).append(value)
+            return data
+        sql = '''
+                SELECT %s FROM %s
+            '''%(target, table)
+        with perf.span('read_db_data', table=table):
+            records = self.query(sql, [], table, popup)
+        if records is None:
+            return None
+        return [row[0] for row in records]
+
+    @perf.timed('write_session_data')
+    def write_session(self, conn, df_session, popup=True):
+        '''Write session rows to session table (no commit); return True if successful'''
+        IntegrityError = self.integrity_error(conn)
+        sql = '''
+                INSERT INTO "%s" (ADate, [Operator 1], [Operator 2], MachineName, GA, Energy, \
+                    Electrometer, Voltage, ChamberType, Chamber, Temperature, Pressure, LinearityPass, RepeatabilityPass, Comments)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+              '''%(SESSION_TABLE)
+        cursor = conn.cursor()
+        data = _to_params(df_session)
+
+        try:
+            print("Writing session to database...")
+            cursor.executemany(sql, data)
+            return True
+        except IntegrityError:
+            if popup:
+                _popup("Session Write Error","WARNING: Write to database failed.")
+            print("Integrity Error, nothing written to database")
+            return False
+        finally:
+            cursor.close()
+
+    @perf.timed('write_results_data')
+    def write_results(self, conn, df_results, popup=True):
+        '''Write results rows to results table (no commit); return True if successful'''
+        IntegrityError = self.integrity_error(conn)
+        sql = '''
+                INSERT INTO "%s" (RTimestamp, ADate, MUindex, MU, Rmean, \
+                    Rdifflinearity, Rstd, Rratio, MUratio, R, VarPass)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?)
+             '''%(RESULTS_TABLE)
+        cursor = conn.cursor()
+        data = _to_params(df_results)
+
+        try:
+            print("Writing results to database...")
+            cursor.executemany(sql, data)
+            return True
+        except IntegrityError:
+            if popup:
+                _popup("Results Write Error","WARNING: Write to database failed.")
+            print("Integrity Error, results not written to database")
+            return False
+        finally:
+            cursor.close()
+
+    def write(self, df_session, df_results, popup=True):
+        '''Write session and results dataframes in one transaction; return True if committed'''
+        conn = None
+
+        if not self.ready():
+            if popup:
+                _popup("Write Failed.","Provide a path to the Access Database.")
+            return False
+
+        with self.pool.lock:
+            try:
+                conn = self.pool.get()
+            except Exception:
+                if popup:
+                    _popup("Could not connect to database, nothing written","WARNING")
+                print("Could not connect to database; nothing written")
+                return False
+
+            try:
+                return self._transaction(conn, df_session, df_results, popup)
+            except Exception:
+                if self.pool._healthy():
+                    raise
+                # handle dropped since the last health check, retry once on a new connection
+                print("Database connection lost, reconnecting...")
+            try:
+                conn = self.pool.reconnect()
+                return self._transaction(conn, df_session, df_results, popup)
+            except Exception as e:
+                if popup:
+                    _popup("Could not connect to database, nothing written","WARNING")
+                print("Database write failed; nothing written: "+str(e))
+                return False
+
+    def _transaction(self, conn, df_session, df_results, popup=True):
+        written = False
+        try:
+            session_written = self.write_session(conn,df_session,popup)
+            print("Session Write Status: "+str(session_written))
+            if session_written:
+                results_written = self.write_results(conn,df_results,popup)
+                print("Results Write Status: "+str(results_written))
+                written = results_written
+        finally:
+            if written:
+                conn.commit()
+            else:
+                # a dead handle can fail to roll back; don't hide the original error
+                try:
+                    conn.rollback()
+                except Exception as e:
+                    print("Rollback failed: "+str(e))
+                print("Transaction rolled back; nothing written to database")
+        return written
+
+    def query_history(self, machine, chamber=None, energy_min=None, energy_max=None, chunk_size=1000):
+        '''
+            Stream results history for a gantry, optionally filtered by chamber and energy range.
+            Yields lists of (ADate, MachineName, Chamber, Energy, MUindex, MU, R) rows, chunk_size at a time.
+        '''
+        sql = '''
+                SELECT s.ADate, s.MachineName, s.Chamber, s.Energy, r.MUindex, r.MU, r.R
+                FROM "%s" AS s INNER JOIN "%s" AS r ON s.ADate = r.ADate
+                WHERE s.MachineName = ?
+            '''%(SESSION_TABLE, RESULTS_TABLE)
+        params = [machine]
+        if chamber is not None:
+            sql += ' AND s.Chamber = ?'
+            params.append(chamber)
+        if energy_min is not None:
+            sql += ' AND s.Energy >= ?'
+            params.append(energy_min)
+        if energy_max is not None:
+            sql += ' AND s.Energy <= ?'
+            params.append(energy_max)
+        sql += ' ORDER BY '+self.ORDER_BY
+
+        if not self.ready():
+            print("Database Path Missing!")
+            return
+        with self.pool.lock:
+            cursor = self.pool.get().cursor()
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+
+class AccessBackend(Backend):
+    '''Microsoft Access database at DB_PATH through pypyodbc'''
+    def connect(self):
+        import pypyodbc
+        return pypyodbc.connect(_connection_string())
+
+    def ready(self):
+        return bool(DB_PATH)
+
+
+class SQLiteBackend(Backend):
+    '''SQLite file with the same tables, for offline use, load tests and benchmarks'''
+    ORDER_BY = 's.ATime'
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        super().__init__()
+
+    def connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for sql in SQLITE_SCHEMA[:3]:
+            conn.execute(sql)
+        # files created before ATime existed get the column added
+        if 'ATime' not in [row[1] for row in conn.execute('PRAGMA table_xinfo("%s")'%(SESSION_TABLE))]:
+            conn.execute('ALTER TABLE "%s" ADD COLUMN ATime TEXT %s'%(SESSION_TABLE, SQLITE_ATIME))
+        for sql in SQLITE_SCHEMA[3:]:
+            conn.execute(sql)
+        conn.commit()
+        return conn
+
+    def ready(self):
+        return True
+
+
+backend = AccessBackend()
+atexit.register(lambda: backend.close())
+
+def set_backend(new_backend):
+    '''Switch database backend, e.g. set_backend(SQLiteBackend('qa.sqlite')) to run offline'''
+    global backend
+    backend.close()
+    backend = new_backend
+
+# reference list lookups held in the local cache
+OPERATOR_KEY = rc.cache_key('Operators', 'Initials')
+ASSET_MODELS = {'Roos': 'TW34001SC', 'Semiflex': 'TW31021', 'El': 'UnidosE'}
+ASSET_KEYS = {k: rc.cache_key('Assets', '[Serial Number]', 'Model', m) for k, m in ASSET_MODELS.items()}
+LOOKUP_KEYS = [OPERATOR_KEY] + list(ASSET_KEYS.values())
+
+cache = rc.RefCache()
+
+def fetch_lookups(popup=True):
+    '''Query the database for all reference lists; return {cache key: list or None}'''
+    fields = {'table': 'Operators', 'target': 'Initials', 'filter_var': None}
+    lookups = {OPERATOR_KEY: read_db_data(fields, popup=popup)}
+    assets = read_assets(list(ASSET_MODELS.values()), popup=popup)
+    if not assets:
+        assets = {}
+    for k, m in ASSET_MODELS.items():
+        lookups[ASSET_KEYS[k]] = assets.get(m)
+    return lookups
+
+def lookup_versions():
+    '''
+        Cheap version of each reference list: [row count, min, max] of its key column.
+        Return {cache key: version}, or None if the database cannot be queried.
+    '''
+    models = list(ASSET_MODELS.values())
+    with perf.span('lookup_versions'):
+        operators = backend.query("SELECT COUNT(*), MIN(Initials), MAX(Initials) FROM Operators", [],
+                                  'Operators', popup=False)
+        assets = backend.query("SELECT Model, COUNT(*), MIN([Serial Number]), MAX([Serial Number]) FROM Assets "
+                               "WHERE Model IN (%s) GROUP BY Model"%(','.join(['?']*len(models))),
+                               models, 'Assets', popup=False)
+    if operators is None or assets is None:
+        return None
+    versions = {OPERATOR_KEY: list(operators[0])}
+    by_model = {row[0]: list(row[1:]) for row in assets}
+    for k, m in ASSET_MODELS.items():
+        versions[ASSET_KEYS[k]] = by_model.get(m)
+    return versions
+
+def refresh_fields(callback=None, force=False):
+    '''
+        Refresh stale reference lists on a worker thread, skipping the full fetch
+        when the table versions are unchanged.
+        callback(populate_fields(), connected) is called from the worker when done.
+    '''
+    status = {'connected': False}
+    def _version():
+        versions = lookup_versions()
+        status['connected'] = versions is not None
+        return versions
+    def _fetch():
+        lookups = fetch_lookups(popup=False)
+        status['connected'] = all(v is not None for v in lookups.values())
+        return lookups
+    def _done(changed):
+        if callback:
+            callback(populate_fields(fetch=False), status['connected'])
+    return cache.refresh(_fetch, LOOKUP_KEYS, _done, force, _version)
 
-def populate_fields():
-    print("Connecting to database...")
+def check_connection(callback):
+    '''Ping the database on a worker thread; callback(populate_fields(), connected) when done'''
+    def _worker():
+        connected = backend.ping()
+        callback(populate_fields(fetch=False), connected)
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+    return thread
+
+@perf.timed('populate_fields')
+def populate_fields(fetch=True):
+    '''Return GUI lists from the reference cache, querying the database only if the cache is empty'''
+    print("Loading reference lists...")
     connection_flag = True
+    if fetch and any(cache.get(k) is None for k in LOOKUP_KEYS):
+        print("Connecting to database...")
+        cache.update(fetch_lookups())
     # baseline data needs updating
     baseline_readings = [[5,10,14,20,25],[3,6,8.4,12,15]]
     # gantry list
@@ -30,154 +494,83 @@ def populate_fields():
     # electrometer range list
     Rng = ['Low','Medium','High']
     # operator list
-    fields = {'table': 'Operators', 'target': 'Initials', 'filter_var': None}
-    Op = read_db_data(fields)
+    Op = cache.get(OPERATOR_KEY)
     if not Op:
         Op = ['AB', 'AG', 'AGr', 'AJP', 'AK', 'AM', 'AT', 'AW', 'CB', 'CG', 'PI', 'RM', 'SC', 'SG', 'SavC', 'TNC', 'VMA', 'VR']
         connection_flag = False
     Op.sort()
     # chamber list
-    fields = {'table': 'Assets', 'target': "[Serial Number]", 'filter_var': "Model", 'filter_val': 'TW34001SC'}
-    Roos = read_db_data(fields)
+    Roos = cache.get(ASSET_KEYS['Roos'])
     if not Roos:
         Roos = ['003126', '003128', '003131', '003132']
         connection_flag = False
-    fields['filter_val'] = 'TW31021'
-    Semiflex = read_db_data(fields)
+    Semiflex = cache.get(ASSET_KEYS['Semiflex'])
     if not Semiflex:
         Semiflex = ['142438', '142586', '142587']
         connection_flag = False
     Ch = []
     # electrometer list
-    fields['filter_val'] = 'UnidosE'
-    El = read_db_data(fields)
+    El = cache.get(ASSET_KEYS['El'])
     if not El:
         El = ['92579', '92580', '92581']
         connection_flag = False
     if connection_flag:
-        print("Connected...")
+        print("Reference lists loaded...")
     return G, Chtype, V, Rng, Op, Roos, Semiflex, Ch, El, baseline_readings
 
-def read_db_data(fields):
+def read_db_data(fields, popup=True):
     ''' Return field records from a table as a list'''
-    target = fields['target']
-    table = fields['table']
-    filter_var = fields['filter_var']
-    if filter_var:
-        filter_val = fields['filter_val']
-
-    conn=None
+    if fields['filter_var']:
+        data = backend.read_lookup(fields['table'], fields['target'], fields['filter_var'], [fields['filter_val']], popup)
+        return data[fields['filter_val']] if data is not None else None
+    return backend.read_lookup(fields['table'], fields['target'], popup=popup)
 
-    if not DB_PATH:
-        sg.popup("Path Error.","Provide a path to the Access Database.")
-        print("Database Path Missing!")
-        return None
-    if PASSWORD:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    else:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)   
-    try:  
-        conn = pypyodbc.connect(new_connection)                 
-    except:
-        sg.popup("WARNING","Could not connect to database")
-        print("Connection to table "+table+" failed...")
-    if isinstance(conn,pypyodbc.Connection):
-        if filter_var:
-            sql = '''
-                    SELECT %s FROM %s WHERE %s = '%s'
-                '''%(target, table, filter_var, filter_val)
-        else:
-            sql = '''
-                    SELECT %s FROM %s
-                '''%(target, table)
+def read_assets(models, target="[Serial Number]", popup=True):
+    '''Return {model: [target, ...]} for several asset models in one query'''
+    return backend.read_lookup('Assets', target, 'Model', models, popup)
 
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        conn = None
-        data = []
-        for row in records:
-            data.append(row[0])
-        return data
-    else:
+def session_exists(adate):
+    '''True if a session with this ADate is in the database; None if it cannot be queried'''
+    sql = '''
+            SELECT COUNT(*) FROM "%s" WHERE ADate = ?
+        '''%(SESSION_TABLE)
+    records = backend.query(sql, [adate], SESSION_TABLE, popup=False)
+    if records is None:
         return None
+    return records[0][0] > 0
 
-def write_session_data(conn, df_session):
-    '''Write to session table; return True if successful'''
-        
-    cursor = conn.cursor()   
+def existing_sessions():
+    '''Return the set of session ADates already in the database, or None if it cannot be queried'''
     sql = '''
-            INSERT INTO "%s" (ADate, [Operator 1], [Operator 2], MachineName, GA, Energy, \
-                Electrometer, Voltage, ChamberType, Chamber, Temperature, Pressure, LinearityPass, RepeatabilityPass, Comments)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-          '''%(SESSION_TABLE)
-    data = df_session.values.tolist()[0]
-    
-    try:
-        print("Writing session to database...")
-        cursor.execute(sql, data)
-        conn.commit()
-        cursor.close()
-        return True
-    except IntegrityError:
-        sg.popup("Session Write Error","WARNING: Write to database failed.")
-        print("Integrity Error, nothing written to database")
-        return False  
+            SELECT ADate FROM "%s"
+        '''%(SESSION_TABLE)
+    records = backend.query(sql, [], SESSION_TABLE, popup=False)
+    if records is None:
+        return None
+    return set(row[0] for row in records)
 
+def query_history(machine, chamber=None, energy_min=None, energy_max=None, chunk_size=1000):
+    '''Stream (ADate, MachineName, Chamber, Energy, MUindex, MU, R) history rows in chunks'''
+    return backend.query_history(machine, chamber, energy_min, energy_max, chunk_size)
 
-def write_results_data(conn,df_results):
-    """Write results to table; return true if successful"""    
-    
-    cursor = conn.cursor()   
-    sql = '''
-            INSERT INTO "%s" (RTimestamp, ADate, MUindex, MU, Rmean, \
-                Rdifflinearity, Rstd, Rratio, MUratio, R, VarPass) 
-            VALUES (?,?,?,?,?,?,?,?,?,?,?)  
-         '''%(RESULTS_TABLE)
-    print("Writing results to database...")
-    write_flag = True
-    for i,row in df_results.iterrows():
-        try:
-            data = row.values.tolist()
-            for n,j in enumerate(data):
-                if not isinstance(j,(float, int, str)):
-                    data[n] = str(j)
-            cursor.execute(sql, data)
-        except IntegrityError:
-            sg.popup("Results Write Error","WARNING: Write to database failed.")
-            print("Integrity Error, record "+str(i+1)+" not written to database")
-            write_flag = False
-        
-    conn.commit()
-    cursor.close()
-    return write_flag
-
+def _to_params(df):
+    '''Convert a dataframe to a list of parameter tuples in one pass'''
+    cols = []
+    for name in df.columns:
+        col = df[name]
+        if col.dtype == object:
+            col = col.map(lambda j: j if isinstance(j,(float, int, str)) or j is None else str(j))
+        cols.append(col.tolist())
+    return list(zip(*cols))
 
-def write_to_db(df_session,df_results):
-    '''main function: write session and results dataframes to tables'''
-    
-    conn=None
+def write_session_data(conn, df_session, popup=True):
+    '''Write session rows to session table (no commit); return True if successful'''
+    return backend.write_session(conn, df_session, popup)
 
-    if not DB_PATH:
-        sg.popup("Write Failed.","Provide a path to the Access Database.")
-        return
+def write_results_data(conn,df_results, popup=True):
+    """Write results rows to results table (no commit); return true if successful"""
+    return backend.write_results(conn, df_results, popup)
 
-    if PASSWORD:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    else:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)   
-
-    try:  
-        conn = pypyodbc.connect(new_connection)                 
-    except:
-        sg.popup("Could not connect to database, nothing written","WARNING")
-        print("Could not connect to database; nothing written")
-    
-    if isinstance(conn,pypyodbc.Connection):
-        session_written = write_session_data(conn,df_session)
-        print("Session Write Status: "+str(session_written))
-        if session_written:
-            results_written = write_results_data(conn,df_results)
-            print("Results Write Status: "+str(results_written))
+def write_to_db(df_session,df_results, popup=True):
+    '''main function: write session and results dataframes to tables in one transaction'''
+    return backend.write(df_session, df_results, popup)
@@ -1,147 +1,163 @@
+import collections
 import datetime
-import PySimpleGUI as sg
+
+import grid
+
+# PySimpleGUI is imported on first popup so the validator can be used headless
+
+ADATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+DATE_MIN = datetime.datetime(2022, 1, 1)
+DATE_MAX = datetime.datetime(2122, 1, 1)
+
+# declarative schema: (key, label, kind, limits or lookup list, required, codes)
+# kinds: 'date' and 'range' check bounds, 'choice' checks a dropdown list,
+# 'number' allows blanks but must be >= 0, 'text' is only checked if required
+SCHEMA = [
+    ('ADate', 'Date', 'date', (DATE_MIN, DATE_MAX), True, (2, 3)),
+    ('-Op1-', 'Operator 1', 'choice', 'Op', True, (4,)),
+    ('-Op2-', 'Operator 2', 'text', None, False, ()),
+    ('Temp', 'Temperature', 'range', (18., 26.), True, (5, 6)),
+    ('Press', 'Pressure', 'range', (955, 1055), True, (7, 8)),
+    ('-G-', 'Gantry Name', 'choice', 'G', True, (4,)),
+    ('GA', 'Gantry Angle', 'range', (0, 360), True, (9.1, 10.1)),
+    ('EN', 'Energy', 'range', (70, 245), True, (9, 10)),
+    ('-Chtype-', 'Chamber Type', 'text', None, True, ()),
+    ('-Ch-', 'Chamber ID', 'choice', 'Ch', True, (4,)),
+    ('-El-', 'Electrometer ID', 'choice', 'El', True, (4,)),
+    ('-V-', 'Voltage', 'choice', 'V', True, (4,)),
+]
+EMPTY = 1 # code for a missing required field
+
+# GUI keys of the session fields as named in the database and csv exports
+COLUMNS = {'ADate': 'ADate', '-Op1-': 'Operator 1', '-Op2-': 'Operator 2', 'Temp': 'Temperature',
+    'Press': 'Pressure', '-G-': 'MachineName', 'GA': 'GA', 'EN': 'Energy', '-Chtype-': 'ChamberType',
+    '-Ch-': 'Chamber', '-El-': 'Electrometer', '-V-': 'Voltage'}
+
+Violation = collections.namedtuple('Violation', ['record', 'key', 'field', 'code', 'message'])
+
+
+def reading_rules(n_mu=grid.N_MU, n_repeats=grid.N_REPEATS):
+    '''Schema entries for the MU spot weights and readings of the measurement grid'''
+    rules = []
+    for i in range(n_mu):
+        rules.append((grid.mu_key(i), 'Spot Weight, MU'+str(i+1), 'number', None, False, (11,)))
+        for k in range(n_repeats):
+            rules.append((grid.reading_key(i, k), 'R'+str(k+1)+', MU'+str(i+1), 'number', None, False, (12,)))
+    return rules
+
+
+def _compile_rule(key, label, kind, limits, codes, lookups):
+    '''Return check(value) -> (code, message) or None for one schema entry'''
+    if kind == 'date':
+        lo, hi = limits
+        def check(value):
+            try:
+                adate = value if isinstance(value, datetime.datetime) else \
+                    datetime.datetime.strptime(str(value), ADATE_FORMAT)
+            except ValueError:
+                return codes[0], "Enter a valid value for: "+label
+            if not hi >= adate >= lo:
+                return codes[1], "Enter a valid value for: "+label
+    elif kind == 'range':
+        lo, hi = limits
+        def check(value):
+            try:
+                x = float(value)
+            except (TypeError, ValueError):
+                return codes[0], "Enter a number for: "+label
+            if not hi >= x >= lo:
+                return codes[1], "Enter a valid value for: "+label
+    elif kind == 'choice':
+        if lookups is None or lookups.get(limits) is None:
+            return None # list not known, e.g. validating csv offline
+        valid = lookups[limits]
+        def check(value):
+            if str(value) not in valid:
+                return codes[0], "Enter a value from the dropdown list: "+label
+    elif kind == 'number':
+        def check(value):
+            if value == '' or value is None:
+                return None
+            try:
+                if float(value) >= 0:
+                    return None
+            except (TypeError, ValueError):
+                pass
+            return codes[0], "Value must be >= 0: "+label
+    else:
+        return None
+    return check
+
+
+class Validator():
+    '''
+        Schema compiled once into per-field checks. Lookup lists are held as sets.
+        names maps schema keys to the record keys, e.g. COLUMNS for csv records.
+    '''
+    def __init__(self, schema, lookups=None, names=None):
+        self.checks = []
+        if lookups:
+            lookups = {k: set(str(v) for v in vals) if vals is not None else None for k, vals in lookups.items()}
+        for key, label, kind, limits, required, codes in schema:
+            name = names.get(key, key) if names else key
+            self.checks.append((name, label, required, _compile_rule(key, label, kind, limits, codes, lookups)))
+
+    def validate(self, record, index=None):
+        '''Every violation in one record (a dict-like of field values)'''
+        violations = []
+        for name, label, required, check in self.checks:
+            value = record.get(name, '')
+            if value == '' or value is None:
+                if required:
+                    violations.append(Violation(index, name, label, EMPTY, "Enter a value for: "+label))
+                continue
+            if check:
+                failed = check(value)
+                if failed:
+                    violations.append(Violation(index, name, label, *failed))
+        return violations
+
+    def validate_batch(self, records):
+        '''Every violation in an iterable of records (or a dataframe), tagged with the record index'''
+        if hasattr(records, 'to_dict'):
+            records = records.to_dict('records')
+        violations = []
+        for i, record in enumerate(records):
+            violations += self.validate(record, i)
+        return violations
+
+
+def report(violations):
+    '''One message listing every violation'''
+    return '\n'.join(v.message for v in violations)
+
 
 # check all fields are compliant
 class field_check():
-    def __init__(self,Op, G, Ch, El, V):
+    def __init__(self,Op, G, Ch, El, V, n_mu=grid.N_MU, n_repeats=grid.N_REPEATS):
         self.check_fail = None
-        self.Fields = {
-            'ADate': 'Date',
-            '-Op1-': 'Operator 1',
-            '-Op2-': 'Operator 2',
-            'Temp': 'Temperature',
-            'Press': 'Pressure',
-            '-G-': 'Gantry Name',
-            'GA': 'Gantry Angle',
-            'EN': 'Energy',
-            '-Chtype-': 'Chamber Type',
-            '-Ch-': 'Chamber ID',
-            '-El-': 'Electrometer ID',
-            '-V-': 'Voltage'}
-        self.Op = Op
-        self.G = G
-        self.Ch = Ch
-        self.El = El
-        self.V = V
+        self.Fields = {key: label for key, label, *_ in SCHEMA}
+        self.rules = SCHEMA + reading_rules(n_mu, n_repeats)
+        self.update_lists(Op, G, Ch, El, V)
         self.check_complete = None
 
+    def update_lists(self, Op, G, Ch, El, V):
+        '''Valid dropdown values; recompiles the validator with the new lists'''
+        self.validator = Validator(self.rules, {'Op': Op, 'G': G, 'Ch': Ch, 'El': El, 'V': V})
+
+    def violations(self, values):
+        '''Every invalid GUI field, without popups'''
+        return self.validator.validate(values)
+
     def check(self,values):
         '''
-            Parse each GUI field to check the values are valid
-        '''        
-        
-        # helper functions
-        def _range_check(value, key, minval, maxval):
-            if not maxval >= value >= minval:
-                sg.popup("Invalid Value", "Enter a valid value for: "+key)
-                return True
-            else:
-                return False
-        
-        def _list_check(value, key, combo_list):
-            if value not in combo_list:
-                sg.popup("Invalid Value", "Enter a value from the dropdown list: "+key)
-                return True
-            else:
-                return False
-        
-        def _num_check(value, key):
-            if value != '': 
-                try:
-                    if float(value) >= 0:
-                        return False
-                    else:
-                        sg.popup("Value must be >= 0: "+key)
-                        return True
-                except:
-                    sg.popup("Value must >= 0: "+key)
-                    return True
-            else:
-                return False
-
-        # catch blank fields
-        for key in self.Fields.keys():
-            if values[key] == "" and key != "-Op2-":
-                self.check_fail = True
-                sg.popup("Empty Field","Enter a value for: "+self.Fields[key])
-                return False,1
-
-        # parse date field
-        try:
-            adate = datetime.datetime.strptime(values['ADate'],"%d/%m/%Y %H:%M:%S")
-        except:
-            self.check_fail = True
-            sg.popup("Invalid Value", "Enter a valid value for: "+self.Fields['ADate'])
-            return False,2
-        
-        # check date is within valid range
-        self.check_fail = _range_check(adate,
-            self.Fields['ADate'],
-             datetime.datetime.strptime("01/01/2022 00:00:00","%d/%m/%Y %H:%M:%S"),
-             datetime.datetime.strptime("01/01/2122 00:00:00","%d/%m/%Y %H:%M:%S"),
-             )
-        if self.check_fail:
-            return False,3
-
-        # check combo box fields are valid
-        op1 = _list_check(values['-Op1-'],self.Fields['-Op1-'],self.Op) #operator 1
-        g = _list_check(values['-G-'],self.Fields['-G-'],self.G) #machine name
-        ch = _list_check(values['-Ch-'],self.Fields['-Ch-'],self.Ch) #chamber ID
-        el = _list_check(values['-El-'],self.Fields['-El-'],self.El) #electrometer ID
-        v = _list_check(str(values['-V-']),self.Fields['-V-'],self.V) #electrometer voltage
-        if any([op1,g,ch,el,v]):
-            self.check_fail = True
-            return False,4
-
-        # check temperature
-        try:
-           t = _range_check(float(values['Temp']), self.Fields['Temp'], 18., 26.)
-        except:
-            self.check_fail = True
-            return False,5
-        if t:
-            self.check_fail = True
-            return False,6
-
-        # check pressure
-        try:
-           p = _range_check(float(values['Press']), self.Fields['Press'], 955, 1055)
-        except:
-            self.check_fail = True
-            return False,7
-        if p:
-            self.check_fail = True
-            return False,8
-
-        # check beam energy
-        try:
-            en = _range_check(float(values['EN']), self.Fields['EN'], 70, 245)
-        except:
-            self.check_fail = True
-            return False,9
-        if en:
-            self.check_fail = True
-            return False,10
-
-        # check gantry angle
-        try:
-            ga = _range_check(float(values['GA']), self.Fields['GA'], 0, 360)
-        except:
-            self.check_fail = True
-            return False,9.1
-        if ga:
-            self.check_fail = True
-            return False,10.1
-
-        # check readings and MU weightings
-        for i in range(1,6):
-            self.check_fail = _num_check(values['mu'+str(i)], 'Spot Weight, MU'+str(i))
-            if self.check_fail:
-                return False,11
-            for k in range(3):
-                self.check_fail = _num_check(values['r'+str(i)+str(k+1)], 'R'+str(k+1)+', MU'+str(i))
-                if self.check_fail:
-                    return False,12
-
+            Parse each GUI field to check the values are valid; show all problems in one popup
+        '''
+        violations = self.violations(values)
+        self.check_fail = bool(violations)
+        if violations:
+            import PySimpleGUI as sg
+            sg.popup("Invalid Values", report(violations))
+            return False, violations[0].code
         self.check_complete = True
         return self.check_complete,666
@@ -0,0 +1,41 @@
+"""
+Measurement grid: number of MU levels and repeats, and the GUI keys of each cell
+Keys separate the level and repeat numbers so grids larger than 9x9 stay unambiguous.
+"""
+
+N_MU = 5 # MU levels (rows)
+N_REPEATS = 3 # readings per MU level
+MU_DEFAULTS = [5, 10, 14, 20, 25] # fixed spot weights of the standard plan
+SCROLL_ROWS = 10 # larger grids are shown in a scrolling column
+
+
+def mu_key(i):
+    '''Key of the MU spot weight of level i (0-based)'''
+    return 'mu'+str(i+1)
+
+def reading_key(i, k):
+    '''Key of reading k of level i (0-based)'''
+    return 'r'+str(i+1)+'_'+str(k+1)
+
+def mean_key(i):
+    return 'rm'+str(i+1)
+
+def cov_key(i):
+    return 'dr'+str(i+1)
+
+def range_key(i):
+    return '-Rng'+str(i+1)+'-'
+
+def reading_keys(n_mu=N_MU, n_repeats=N_REPEATS):
+    '''{reading key: (i, k)} for every cell of the grid'''
+    return {reading_key(i, k): (i, k) for i in range(n_mu) for k in range(n_repeats)}
+
+def mu_keys(n_mu=N_MU):
+    '''{MU key: i} for every level of the grid'''
+    return {mu_key(i): i for i in range(n_mu)}
+
+def collect(values, n_mu=N_MU, n_repeats=N_REPEATS):
+    '''Readings [level][repeat] and MU [level] from GUI values, as entered'''
+    r_list = [[values[reading_key(i, k)] for k in range(n_repeats)] for i in range(n_mu)]
+    mu_list = [values[mu_key(i)] for i in range(n_mu)]
+    return r_list, mu_list
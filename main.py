@@ -1,19 +1,30 @@
-import datetime
 import time
+t_start = time.perf_counter() # startup timer
+
+import datetime
 import os
-from turtle import color
-import pandas as pd
+import sqlite3
 import numpy as np
 import PySimpleGUI as sg
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
+import analysis as an
 import database_df as db
+import result_keys as rk
 import field_check as fc
+import outbox as ob
+import archive as ar
+import acquisition as acq
+import grid
+import perf
+
+# pandas and matplotlib are imported where they are first needed to keep startup fast
 
 ### Action levels
-CoV_threshold = 0.5
-Chi_threshold = [0,0.2]#[99.9,100.1]
+CoV_threshold = an.COV_THRESHOLD
+Chi_threshold = an.CHI_THRESHOLD#[99.9,100.1]
+
+# electrometer for Acquire: only 'sim' (the simulated UNIDOS) is supported; the button is hidden when unset
+ACQUISITION_PORT = os.environ.get('DOSELINEARITY_ACQUISITION') or None
 
 ### Session and Results Classes
 class DLsession:
@@ -52,65 +63,77 @@ class DLsession:
 
 
 class DLresults():
+    '''
+        Columnar results of one session: one typed array entry per measured MU level
+        and a fixed-width readings matrix R (nan where a repeat was left blank).
+    '''
+    __slots__ = ['RTimestamp', 'ADate', 'MUindex', 'MU', 'Rmean', 'Rdifflinearity', 'Rstd', 'Rratio',
+                 'MUratio', 'R', 'cov', 'VarPass', 'analysed', 'fname']
+
     def __init__(self):
-        self.RTimestamp = []
-        self.ADate = []
-        self.MUindex = []
-        self.MU = []
-        self.Rmean = []
-        self.Rdifflinearity = []
-        self.Rstd = []
-        self.Rratio = []
-        self.MUratio = []
-        self.R = []
-        self.cov = []
-        self.VarPass = []
+        self.RTimestamp = np.empty(0, dtype=object)
+        self.ADate = np.empty(0, dtype=object)
+        self.MUindex = np.empty(0, dtype=int)
+        self.MU = np.empty(0)
+        self.Rmean = np.empty(0)
+        self.Rdifflinearity = np.empty(0)
+        self.Rstd = np.empty(0)
+        self.Rratio = np.empty(0)
+        self.MUratio = np.empty(0)
+        self.R = np.empty((0, 0))
+        self.cov = np.empty(0)
+        self.VarPass = np.empty(0, dtype=object)
         self.analysed = False
         self.fname = 'results.csv'
 
+    @perf.timed('DLresults.analysis')
     def analysis(self,rlist,mulist):
-        R_filt = []
-        for lst in rlist:
-            R_filt.append([x for x in lst if x != '']) # remove blank readings
-        
-        # loop through data and process
-        idx=-1
-        for r, m in zip(R_filt, mulist):
-            idx += 1
-            if r:
-                r = [float(i) for i in r]                    
-                self.MUindex.append(str(idx+1))
-                self.R.append(r)
-                self.Rmean.append(np.mean(r))
-                self.Rstd.append(np.std(r))
-                self.MU.append(float(m))
+        # every measured MU level needs an MU value
+        for r, m in zip(rlist, mulist):
+            if any(x != '' for x in r):
+                float(m)
+        R = an.readings_array([rlist])
+        res = an.analyse(R, an.mu_array([mulist]))
 
         # catch a naughty mistake
-        if len(self.MU)<2:
+        if not res.analysed[0]:
             sg.popup('Insufficient Results', 'Measure more than one dose')
             self.analysed = False
         else:
             self.analysed=True
 
-        # perform analysis
-        for i in range(len(self.MU)):
-            self.RTimestamp.append(datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")[:-4])
-            self.Rratio.append(self.Rmean[i]/self.Rmean[0])
-            self.MUratio.append(self.MU[i]/self.MU[0])
-            self.Rdifflinearity.append(self.Rratio[i]/self.MUratio[i]*100-100)
-            self.cov.append(self.Rstd[i]/self.Rmean[i]*100)
-            time.sleep(0.075)   
+        # keep measured MU levels only
+        idx = np.flatnonzero(~res.Rmean.mask[0])
+        self.MUindex = idx+1
+        self.R = R[0][idx].filled(np.nan)
+        self.MU = res.MU[0,idx].data
+        self.Rmean = res.Rmean[0,idx].data
+        self.Rstd = res.Rstd[0,idx].data
+        self.Rratio = res.Rratio[0,idx].data
+        self.MUratio = res.MUratio[0,idx].data
+        self.Rdifflinearity = res.Rdifflinearity[0,idx].data
+        self.cov = res.cov[0,idx].data
+        self.VarPass = np.full(idx.size, 'PASS', dtype=object)
+        self.RTimestamp = np.array(rk.allocator.allocate(idx.size), dtype=object)
+
+    def fields(self, keys):
+        '''Columns for keys as arrays (views where possible); MUindex and R in their stored text form'''
+        cols = {}
+        for k in keys:
+            if k == 'MUindex':
+                cols[k] = self.MUindex.astype(str).astype(object)
+            elif k == 'R':
+                cols[k] = np.array([str(r[~np.isnan(r)].tolist()) for r in self.R], dtype=object)
+            else:
+                cols[k] = getattr(self, k)
+        return cols
     
-    # linear fit
+    # linear fit through the origin
     def _fit(self):
-        mu = [0]
-        mu.extend(self.MU)
-        r = [0]
-        r.extend(self.Rmean)
-        w = [1]*len(r)
-        w[0] = 1e6
-        a,b = np.polyfit(mu,r,1,w=w)
-        return a, b
+        mu = np.array([self.MU])
+        valid = np.ones(mu.shape, dtype=bool)
+        a, _ = an.fit_origin(mu, np.array([self.Rmean]), valid)
+        return a[0], 0.
 
     # coefficient of determination
     def _cod(self,x,y,a,b):
@@ -124,18 +147,22 @@ class DLresults():
     # Pearson's Chi Square test
     def _prn(self,x,y,a,b):
         '''prn = ChiSq[predicted from MU ratios] - ChiSq[linear fit]'''
-        chi=[]
-        y_pred = x/x[0]*y[0]
-        y_fit = a*x+b
-        prn = np.sum(y**2/y_pred) - np.sum(y**2/y_fit)
-        return abs(prn)
+        valid = np.ones((1,len(x)), dtype=bool)
+        prn = an.chi_statistic(np.array([x]), np.array([y]), valid, np.array([a]), np.array([b]))
+        return prn[0]
+
+    # Monte Carlo interval of prn and probability of passing from the repeat spread
+    def chi_uncertainty(self, threshold):
+        n = (~np.isnan(self.R)).sum(axis=1)
+        return an.chi_uncertainty(self.MU, self.Rmean, self.Rstd, n, threshold)
     
     # perform linear fit after analysis
+    @perf.timed('fit_data')
     def fit_data(self):
-        x = np.array(self.MU)
-        y = np.array(self.Rmean)
-        Rmin = np.array([np.array(i).min() for i in self.R])
-        Rmax = np.array([np.array(i).max() for i in self.R])
+        x = self.MU
+        y = self.Rmean
+        Rmin = np.nanmin(self.R, axis=1)
+        Rmax = np.nanmax(self.R, axis=1)
         yerr = np.empty((2, y.shape[0]))
         yerr[0,:] = y-Rmin
         yerr[1,:] = Rmax-y
@@ -149,103 +176,146 @@ class DLresults():
     
     # timestamp all measurements
     def assign_session(self,adate):
-        for t in self.RTimestamp:
-            self.ADate.append(adate)
-
+        self.ADate = np.full(self.RTimestamp.size, adate, dtype=object)
 
-# Pull inital data from DB
-try:
-    G, Chtype, V, Rng, Op, Roos, Semiflex, Ch, El, baseline_readings =\
-        db.populate_fields()
-except:
-    print("Conection failed...")
-    sg.popup_error("Export all measurements to .csv!",
-    title="Cannot Connect to Database!",
-    image = os.path.abspath(os.path.join(os.path.dirname(__file__), 'db_error.png')),
-    background_color="black",
-    keep_on_top=True)
-x_ref = baseline_readings[0]
-y_ref = baseline_readings[1]
 
 ### Helper functions
 # csv export
-def export_csv(data=None, keys=None, new_keys=None, dname=None):
-    # create dictionary from class data
-    dict = vars(data)
+def _fields(data, keys, new_keys=None):
+    '''Columns for keys from a data object, renamed to new_keys if given'''
+    if hasattr(data, 'fields'):
+        dict = data.fields(keys)
+    else:
+        dict = vars(data)
+        dict = { k: dict[k] for k in keys }
+    if new_keys:
+        for new_key, old_key in zip(new_keys,keys):
+            dict[new_key] = dict.pop(old_key)
+    return dict
 
+@perf.timed('export_csv')
+def export_csv(data=None, keys=None, new_keys=None, dname=None):
     # create timestamped folder
     csv_time = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
     csv_dir = dname+os.sep+csv_time
     os.makedirs(csv_dir, exist_ok=True)
 
-    # retain specified keys and rename if desired
-    dict = { k: dict[k] for k in keys }
-    if new_keys:
-        for new_key, old_key in zip(new_keys,keys):
-            dict[new_key] = dict.pop(old_key)  
-
     # write to csv
-    df = pd.DataFrame({ key:pd.Series(value) for key, value in dict.items() })
+    df = convert2df(data, keys, new_keys)
     fname = csv_dir+os.sep+data.fname
     df.to_csv(fname, index=False)
     print("Saved: "+fname)
 
 # dataframe conversion
 def convert2df(data=None, keys=None, new_keys=None):
-    # create dictionary from class data
-    dict = vars(data)
-
-    # retain specified keys and rename if desired
-    dict = { k: dict[k] for k in keys }
-    if new_keys:
-        for new_key, old_key in zip(new_keys,keys):
-            dict[new_key] = dict.pop(old_key)  
-
-    # write to dataframe
-    df = pd.DataFrame({ key:pd.Series(value) for key, value in dict.items() })
+    import pandas as pd
+    # arrays are handed over without copying; scalars become one-row columns
+    dict = _fields(data, keys, new_keys)
+    df = pd.DataFrame({ key:value if isinstance(value, np.ndarray) else pd.Series(value)
+        for key, value in dict.items() }, copy=False)
     return df
 
 # graph plotting
-_VARS = {'fig_agg': False, 'pltFig': False}
-
-def draw_figure(canvas, figure):
-    figure_canvas_agg = FigureCanvasTkAgg(figure, canvas)
-    figure_canvas_agg.draw()
-    figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
-    return figure_canvas_agg
-
-def format_fig(xData,yData):
-    plt.plot(xData,yData,'--k',linewidth=1)
-    plt.title('Results', fontsize=10, fontweight='bold',color='w')
-    plt.xlabel('Mean Reading (nC)', fontsize=8, fontweight='bold',color='w')
-    plt.ylabel('Spot MU', fontsize=8, fontweight='bold',color='w')
-    plt.xlim([xData[0], xData[-1]+1])
-    plt.ylim([yData[0], yData[-1]+1])
-    plt.xticks(fontsize=8)
-    plt.yticks(np.arange(yData[0],yData[-1]+1,1), fontsize=8)
-    plt.tick_params(colors='w')
-    plt.grid(visible=True)
-    plt.tight_layout()
-
-def init_figure(xref,yref):
-    _VARS['pltFig'] = plt.figure(figsize=(4.75,3), facecolor='#404040')
-    format_fig(xref,yref)
-    _VARS['fig_agg'] = draw_figure(window['figCanvas'].TKCanvas, _VARS['pltFig'])
-
-def update_fig(x,y,yerr,xref,yref):
-    _VARS['fig_agg'].get_tk_widget().forget()
-    plt.clf()
-    format_fig(xref, yref)
-    if x is not None:
-        plt.errorbar(x, y, yerr=yerr, fmt='g.', ecolor='k', elinewidth=1)
-        plt.xlim([xref.min(),xref.max()+1])
-        plt.ylim([yref.min(),y.max()+yerr.max()+1])
-        plt.yticks(np.arange(yref.min(),yref.max()+1,1), fontsize=8)
-    _VARS['fig_agg'] = draw_figure(
-        window['figCanvas'].TKCanvas, _VARS['pltFig'])
+class LinearityPlot():
+    '''
+        Figure embedded once in the window. Updates only change artist data and
+        limits; limits are snapped to coarse steps so they rarely change, and
+        while they are unchanged the data artists are blitted.
+    '''
+    def __init__(self, canvas, xref, yref):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.fig = Figure(figsize=(4.75,3), facecolor='#404040')
+        self.ax = self.fig.add_subplot()
+        self.ax.set_title('Results', fontsize=10, fontweight='bold',color='w')
+        self.ax.set_xlabel('Mean Reading (nC)', fontsize=8, fontweight='bold',color='w')
+        self.ax.set_ylabel('Spot MU', fontsize=8, fontweight='bold',color='w')
+        self.ax.tick_params(colors='w', labelsize=8)
+        self.ax.grid(visible=True)
+
+        # reference line and error bars are created once and animated
+        self.ref_line, = self.ax.plot(xref, yref, '--k', linewidth=1, animated=True)
+        self.points, _, (self.bars,) = self.ax.errorbar([], [], yerr=[[],[]], fmt='g.', ecolor='k', elinewidth=1)
+        self.points.set_animated(True)
+        self.bars.set_animated(True)
+        self.limits = None
+        self.background = None
+        self._set_limits(*self._limits(None, None, None, np.asarray(xref), np.asarray(yref)))
+        self.fig.tight_layout()
+
+        self.canvas = FigureCanvasTkAgg(self.fig, canvas)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+        self.canvas.draw()
+
+    @staticmethod
+    def _snap(lo, hi):
+        '''Widen (lo, hi) out to multiples of the power of ten below its span'''
+        step = 10.**np.floor(np.log10(max(hi-lo, 1.)))
+        return float(np.floor(lo/step)*step), float(np.ceil(hi/step)*step)
+
+    def _limits(self, x, y, yerr, xref, yref):
+        if x is None:
+            return self._snap(xref[0], xref[-1]+1), self._snap(yref[0], yref[-1]+1), self._snap(yref[0], yref[-1]+1)
+        return (self._snap(xref.min(), xref.max()+1), self._snap(yref.min(), y.max()+yerr.max()+1),
+                self._snap(yref.min(), yref.max()+1))
+
+    def _set_limits(self, xlim, ylim, yticks):
+        self.limits = (xlim, ylim, yticks)
+        self.ax.set_xlim(xlim)
+        self.ax.set_ylim(ylim)
+        self.ax.set_yticks(np.arange(yticks[0], yticks[1], 1))
+
+    def _draw_artists(self):
+        for artist in [self.ref_line, self.bars, self.points]:
+            self.ax.draw_artist(artist)
+
+    def _on_draw(self, event):
+        # full redraw: keep the static background for blitting
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    @perf.timed('update_fig')
+    def update(self, x, y, yerr, xref, yref):
+        '''Show results (x is None to clear) against the reference line'''
+        xref, yref = np.asarray(xref), np.asarray(yref)
+        self.ref_line.set_data(xref, yref)
+        if x is None:
+            self.points.set_data([], [])
+            self.bars.set_segments([])
+        else:
+            self.points.set_data(x, y)
+            self.bars.set_segments([[(xi, yi-lo), (xi, yi+hi)] for xi, yi, lo, hi in zip(x, y, yerr[0], yerr[1])])
+        limits = self._limits(x, y, yerr, xref, yref)
+        if limits != self.limits or self.background is None:
+            self._set_limits(*limits)
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_artists()
+            self.canvas.blit(self.fig.bbox)
+
+def update_live(window, live, i):
+    '''Refresh mean/CoV of MU level i and the chi value from the running statistics'''
+    mean, cov = live.row(i)
+    if mean is None:
+        window[grid.mean_key(i)]('', background_color='lightgray')
+        window[grid.cov_key(i)]('', background_color='lightgray')
+    else:
+        window[grid.mean_key(i)]('%.3f' % mean)
+        window[grid.cov_key(i)]('%.3f' % cov, background_color='red' if abs(cov)>CoV_threshold else 'green')
+    window['ChiCI']('') # interval belongs to the last analysis
+    window['ChiP']('')
+    prn = live.chi()
+    if prn is None:
+        window['Chi']('', background_color='lightgray')
+    elif Chi_threshold[0] <= prn <= Chi_threshold[1]:
+        window['Chi']('%.3f' % prn, background_color='green')
+    else:
+        window['Chi']('%.3f' % prn, background_color='red')
 
 ### GUI window function
-def build_window():
+def build_window(G, Chtype, V, Rng, Op, Ch, El, n_mu=grid.N_MU, n_repeats=grid.N_REPEATS):
     #theme
     sg.theme('Dark2')
 
@@ -278,65 +348,29 @@ def build_window():
         [sg.T('Voltage (V)', justification='right', size=(12,1)), sg.DD(V, size=(11,1), enable_events=True, key='-V-')],
     ]
 
-    #results
-    mu_layout = [ 
-        [sg.T('MU per Spot:')],
-        [sg.T('MU1', size=(3,1)), sg.InputText(key='mu1', disabled=True, default_text=5, size=(7,1), enable_events=True)],
-        [sg.T('MU2', size=(3,1)), sg.InputText(key='mu2', disabled=True, default_text=10, size=(7,1), enable_events=True)],
-        [sg.T('MU3', size=(3,1)), sg.InputText(key='mu3', disabled=True, default_text=14, size=(7,1), enable_events=True)],
-        [sg.T('MU4', size=(3,1)), sg.InputText(key='mu4', disabled=True, default_text=20, size=(7,1), enable_events=True)],
-        [sg.T('MU5', size=(3,1)), sg.InputText(key='mu5', disabled=True, default_text=25, size=(7,1), enable_events=True)],
-    ]
-    e_layout = [
-        [sg.T('Electrometer Range:')],
-        [sg.DD(Rng, size=(15,1), default_value=Rng[1], enable_events=True, key='-Rng1-')],
-        [sg.DD(Rng, size=(15,1), default_value=Rng[1], enable_events=True, key='-Rng2-')],
-        [sg.DD(Rng, size=(15,1), default_value=Rng[1], enable_events=True, key='-Rng3-')],
-        [sg.DD(Rng, size=(15,1), default_value=Rng[2], enable_events=True, key='-Rng4-')],
-        [sg.DD(Rng, size=(15,1), default_value=Rng[2], enable_events=True, key='-Rng5-')],
-    ]
-    r1_layout = [
-        [sg.T('R1 (nC):')],
-        [sg.InputText(key='r11', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r21', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r31', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r41', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r51', default_text='', size=(7,1), enable_events=True)],
-    ]
-    r2_layout = [
-        [sg.T('R2 (nC):')],
-        [sg.InputText(key='r12', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r22', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r32', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r42', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r52', default_text='', size=(7,1), enable_events=True)],
-    ]
-    r3_layout = [
-        [sg.T('R3 (nC):')],
-        [sg.InputText(key='r13', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r23', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r33', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r43', default_text='', size=(7,1), enable_events=True)],
-        [sg.InputText(key='r53', default_text='', size=(7,1), enable_events=True)],
-    ]
-    rm_layout = [
-        [sg.T('R avg (nC):')],
-        [sg.T('', background_color='lightgray', text_color='black', justification='right',  key='rm1', size=(10,1))],
-        [sg.T('', background_color='lightgray', text_color='black', justification='right',  key='rm2', size=(10,1))],
-        [sg.T('', background_color='lightgray', text_color='black', justification='right',  key='rm3', size=(10,1))],
-        [sg.T('', background_color='lightgray', text_color='black', justification='right',  key='rm4', size=(10,1))],
-        [sg.T('', background_color='lightgray', text_color='black', justification='right',  key='rm5', size=(10,1))],
-    ]
-    dr_layout = [
-        [sg.T('Coeff of Var (%):')],
-        [sg.T('', background_color='lightgray', justification='right', key='dr1', size=(10,1))],
-        [sg.T('', background_color='lightgray', justification='right', key='dr2', size=(10,1))],
-        [sg.T('', background_color='lightgray', justification='right', key='dr3', size=(10,1))],
-        [sg.T('', background_color='lightgray', justification='right', key='dr4', size=(10,1))],
-        [sg.T('', background_color='lightgray', justification='right', key='dr5', size=(10,1))],
+    #results: one row per MU level
+    grid_layout = [
+        [sg.T('MU per Spot:', size=(12,1)), sg.T('Electrometer Range:', size=(16,1))] +
+        [sg.T('R'+str(k+1)+' (nC):', size=(8,1)) for k in range(n_repeats)] +
+        [sg.T('R avg (nC):', size=(10,1)), sg.T('Coeff of Var (%):', size=(13,1))],
     ]
+    for i in range(n_mu):
+        mu = grid.MU_DEFAULTS[i] if i < len(grid.MU_DEFAULTS) else ''
+        grid_layout.append(
+            [sg.T('MU'+str(i+1), size=(4,1)),
+             sg.InputText(key=grid.mu_key(i), disabled=mu != '', default_text=mu, size=(7,1), enable_events=True),
+             sg.DD(Rng, size=(15,1), default_value=Rng[1] if i < 3 else Rng[2], enable_events=True, key=grid.range_key(i))] +
+            [sg.InputText(key=grid.reading_key(i, k), default_text='', size=(8,1), enable_events=True) for k in range(n_repeats)] +
+            [sg.T('', background_color='lightgray', text_color='black', justification='right', key=grid.mean_key(i), size=(10,1)),
+             sg.T('', background_color='lightgray', justification='right', key=grid.cov_key(i), size=(10,1))])
+    if n_mu > grid.SCROLL_ROWS:
+        grid_column = sg.Column(grid_layout, scrollable=True, vertical_scroll_only=True, size=(None, 30*grid.SCROLL_ROWS))
+    else:
+        grid_column = sg.Column(grid_layout)
     chi_layout = [
-        [sg.T('Chi Sqaure')],[sg.T('', background_color='lightgray', justification='right', key='Chi', size=(10,1))]
+        [sg.T('Chi Sqaure')],[sg.T('', background_color='lightgray', justification='right', key='Chi', size=(10,1))],
+        [sg.T('Chi 95% CI')],[sg.T('', background_color='lightgray', justification='right', key='ChiCI', size=(14,1))],
+        [sg.T('P(pass) (%)')],[sg.T('', background_color='lightgray', justification='right', key='ChiP', size=(10,1))],
     ]
     ml_layout = [
         [sg.Multiline('', key='-ML-', enable_events=True, size=(96,5))],
@@ -347,16 +381,19 @@ def build_window():
         [sg.B('Submit to Database', disabled=True, key='-Submit-'),
         sg.B('Analyse Session', key='-AnalyseS-'),
         sg.FolderBrowse('Export to CSV', key='-CSV_WRITE-', disabled=True, target='-Export-'), sg.In(key='-Export-', enable_events=True, visible=False),
+        sg.B('Archive', disabled=True, key='-Archive-'),
+        sg.B('Acquire', key='-Acquire-', visible=ACQUISITION_PORT is not None),
         sg.B('Clear', key='-Clear-'),
-        sg.B('End Session', key='-Cancel-')],
+        sg.B('End Session', key='-Cancel-'),
+        sg.T('', key='-Status-', size=(60,1)),
+        sg.T('', key='-Queue-', size=(40,1))],
     ]
 
     #combine layout elements
     layout = [
         [sg.Column(sess0_layout), sg.Column(plt_layout)],
         [sg.Frame('Equipment',[[sg.Column(sess1_layout), sg.Column(sess2_layout), sg.Column(sess3_layout)]])],
-        [sg.Frame('Measurements',[[sg.Column(mu_layout),sg.Column(e_layout),sg.Column(r1_layout),sg.Column(r2_layout),sg.Column(r3_layout),
-         sg.Column(rm_layout),sg.Column(dr_layout),sg.Column(chi_layout)]])],
+        [sg.Frame('Measurements',[[grid_column,sg.Column(chi_layout, vertical_alignment='top')]])],
         [sg.Frame('Comments', ml_layout)],
         [button_layout],
     ]
@@ -365,177 +402,316 @@ def build_window():
     return sg.Window('Dose Linearity', layout, finalize=True, icon=icon_file)
 
 
-### Initialise data objects
-results = DLresults()
-session = DLsession()
-session_keys = [i for i in vars(session).keys() if i not in 'fname']
-new_keys = ['ADate', 'Operator 1', 'Operator 2', 'MachineName', 'GA', 'Energy',
-'Electrometer', 'Voltage', 'ChamberType', 'Chamber', 'Temperature', 'Pressure', 'LinearityPass', 'RepeatabilityPass', 'Comments']
-results_keys = [i for i in vars(results).keys() if i not in ['analysed', 'fname', 'cov']]
-
-field_check = fc.field_check(Op, G, Roos+Semiflex, El, [str(i) for i in V])
-
-### Generate GUI
-window = build_window()
-session_analysed = False
-init_figure(x_ref,y_ref)
-
-# Event Loop listens out for events e.g. button presses
-while True:
-    event, values = window.read()
-    ### reset analysed flag if there is just about any event
-    if event not in ['-Submit-','-AnalyseS-','-Export-','-ML-',sg.WIN_CLOSED]:
-        session_analysed=False
-        window['-CSV_WRITE-'](disabled=True) # disable csv export button
-        window['-Submit-'](disabled=True) # disable access export button
-        
-    ### Button events
-    if event == '-Submit-': ### Submit data to database
-        if session_analysed:
-            checked, msg = field_check.check(values)
-            if checked:
-                df_session = convert2df(session, session_keys, new_keys)
-                df_results = convert2df(results, results_keys)
-                db.write_to_db(df_session,df_results)
-                print('Data submitted to database.')
-                session_analysed=True
-                window['-Submit-'](disabled=True) # disable access export button
-                window['-AnalyseS-'](disabled=True) # disable access export button
-                window['ADate'](disabled=True) # freeze session ID
+def main(n_mu=grid.N_MU, n_repeats=grid.N_REPEATS):
+    '''Load reference lists, open the window and run the event loop'''
+    # Pull inital data from the reference cache; the database is queried after the window opens
+    G, Chtype, V, Rng, Op, Roos, Semiflex, Ch, El, baseline_readings =\
+        db.populate_fields(fetch=False)
+    x_ref = baseline_readings[0]
+    y_ref = baseline_readings[1]
+
+    ### Initialise data objects
+    results = DLresults()
+    session = DLsession()
+    session_keys = [i for i in vars(session).keys() if i not in 'fname']
+    new_keys = ['ADate', 'Operator 1', 'Operator 2', 'MachineName', 'GA', 'Energy',
+    'Electrometer', 'Voltage', 'ChamberType', 'Chamber', 'Temperature', 'Pressure', 'LinearityPass', 'RepeatabilityPass', 'Comments']
+    results_keys = db.RESULTS_COLUMNS
+
+    field_check = fc.field_check(Op, G, Roos+Semiflex, El, [str(i) for i in V], n_mu, n_repeats)
+
+    ### Generate GUI
+    window = build_window(G, Chtype, V, Rng, Op, Ch, El, n_mu, n_repeats)
+    session_analysed = False
+    plot = LinearityPlot(window['figCanvas'].TKCanvas, x_ref, y_ref)
+    print("Time to interactive: %.2f s" % (time.perf_counter()-t_start))
+
+    # running statistics updated as readings are typed
+    r_keys = grid.reading_keys(n_mu, n_repeats)
+    mu_keys = grid.mu_keys(n_mu)
+    live = an.LiveStats(n_mu, n_repeats)
+    for key, i in mu_keys.items():
+        live.set_mu(i, window[key].get())
+
+    # equipment lookup on a worker thread; results are posted back to the event loop
+    def fields_refreshed(fields, connected):
+        window.write_event_value('-Fields-', (fields, connected))
+    if db.refresh_fields(fields_refreshed) is None:
+        # lists are fresh in the cache; still check the database is reachable
+        db.check_connection(fields_refreshed)
+    window['-Status-']('Database: connecting...')
+
+    # queued submissions are written to the database by the outbox worker
+    def outbox_progress(pending, failed, msg):
+        window.write_event_value('-Outbox-', (pending, failed, msg))
+    outbox = ob.Outbox()
+    outbox.start(outbox_progress)
+    if outbox.failed():
+        window['-Queue-']('Outbox: %d queued, %d failed' % (outbox.pending(), outbox.failed()), background_color='red')
+    else:
+        window['-Queue-']('Outbox: %d queued' % outbox.pending())
+
+    # electrometer readings are posted to the event loop as they arrive
+    acquisition = None
+    def reading_arrived(i, k, value, rng):
+        window.write_event_value('-Reading-', (i, k, value, rng))
+    def acquisition_done():
+        window.write_event_value('-AcqDone-', None)
+
+    # Event Loop listens out for events e.g. button presses
+    while True:
+        event, values = window.read()
+        ### reset analysed flag if there is just about any event
+        if event not in ['-Submit-','-AnalyseS-','-Export-','-Archive-','-ML-','-Fields-','-Outbox-',sg.WIN_CLOSED]:
+            session_analysed=False
+            window['-CSV_WRITE-'](disabled=True) # disable csv export button
+            window['-Archive-'](disabled=True) # disable archive button
+            window['-Submit-'](disabled=True) # disable access export button
+
+        ### Stream readings from the electrometer into the empty slots
+        if event == '-Acquire-':
+            if acquisition is not None and acquisition.running():
+                acquisition.stop()
             else:
+                slots = [(i, k) for key, i in mu_keys.items() if values[key] != ''
+                         for k in range(n_repeats) if values[grid.reading_key(i, k)] == '']
+                try:
+                    mu = [float(values[grid.mu_key(i)]) for i, k in slots]
+                except ValueError:
+                    sg.popup('Invalid Values', 'Enter valid MU spot weights')
+                    slots = []
+                if slots:
+                    try:
+                        transport = acq.open_transport(ACQUISITION_PORT, mu)
+                    except ValueError as e:
+                        print(e)
+                        sg.popup('No Electrometer', str(e))
+                        transport = None
+                    if transport is not None:
+                        acquisition = acq.Acquisition(transport, slots, reading_arrived, acquisition_done)
+                        acquisition.start()
+                        window['-Acquire-']('Stop')
+        if event == '-Reading-':
+            i, k, value, rng = values['-Reading-']
+            window[grid.reading_key(i, k)]('%.4f' % value)
+            if rng:
+                window[grid.range_key(i)](rng) # range the electrometer actually used
+            live.set_reading(i, k, '%.4f' % value)
+            update_live(window, live, i)
+        if event == '-AcqDone-':
+            window['-Acquire-']('Acquire')
+
+        ### Live statistics for the edited MU level
+        if event in r_keys:
+            i, k = r_keys[event]
+            try:
+                live.set_reading(i, k, values[event])
+            except ValueError:
+                live.set_reading(i, k, None) # incomplete entry, e.g. '-' or '1e'
+            update_live(window, live, i)
+        if event in mu_keys:
+            i = mu_keys[event]
+            try:
+                live.set_mu(i, values[event])
+            except ValueError:
+                live.set_mu(i, None)
+            update_live(window, live, i)
+
+        ### Button events
+        if event == '-Submit-': ### Submit data to database
+            if session_analysed:
+                checked, msg = field_check.check(values)
+                if checked:
+                    df_session = convert2df(session, session_keys, new_keys)
+                    df_results = convert2df(results, results_keys)
+                    if outbox.enqueue(df_session,df_results):
+                        print('Data submitted to outbox.')
+                    else:
+                        window['-Queue-']('Outbox: session %s already queued - new data not submitted' % values['ADate'],
+                                          background_color='red')
+                    session_analysed=True
+                    window['-Submit-'](disabled=True) # disable access export button
+                    window['-AnalyseS-'](disabled=True) # disable access export button
+                    window['ADate'](disabled=True) # freeze session ID
+                else:
+                    session_analysed = False
+                    window['-Submit-'](disabled=False) # disable access export button
+                    print(msg)
+            else:
+                sg.popup('Analysis Required', 'Analyse the session before submitting to database')
+
+        if event == '-AnalyseS-': ### Analyse results
+            # collect results
+            r_list, mu_list = grid.collect(values, n_mu, n_repeats)
+            # analyse valid results
+            try:
+                # convert string to float
+                r_list = [[float(r) if r != '' else r for r in row] for row in r_list]
+                mu_list = [float(i) if i != '' else i for i in mu_list]
+                # analyse results
+                results.__init__()
+                results.analysis(r_list,mu_list)
+                results.assign_session(values['ADate'])
+                session_analysed = results.analysed
+                # record session info
+                session.analysis(values)
+            except:
+                sg.popup("Invalid Values", "Enter valid readings")
+                # record session info
                 session_analysed = False
-                window['-Submit-'](disabled=False) # disable access export button
-                print(msg)
-        else:
-            sg.popup('Analysis Required', 'Analyse the session before submitting to database')
-
-    if event == '-AnalyseS-': ### Analyse results
-        # collect results
-        r_list = [
-            [values['r11'], values['r12'], values['r13']],
-            [values['r21'], values['r22'], values['r23']],
-            [values['r31'], values['r32'], values['r33']],
-            [values['r41'], values['r42'], values['r43']],
-            [values['r51'], values['r52'], values['r53']],
-        ]
-        mu_list = [
-            values['mu1'],
-            values['mu2'],
-            values['mu3'],
-            values['mu4'],
-            values['mu5'],
-        ]
-        # analyse valid results
-        try:
-            # convert string to float
-            for k in r_list:
-                for n in range(3):
-                    if k[n] != '':
-                        k[n] = float(k[n])
-            mu_list = [float(i) if i != '' else i for i in mu_list]
-            # analyse results
-            results.__init__()
-            results.analysis(r_list,mu_list)
-            results.assign_session(values['ADate'])
-            session_analysed = results.analysed
-            # record session info
-            session.analysis(values)
-        except:
-            sg.popup("Invalid Values", "Enter valid readings")
-            # record session info
-            session_analysed = False
-            
-        # update GUI
-        if session_analysed:
-            window['-CSV_WRITE-'](disabled=False) # enable Export button
-            window['-Submit-'](disabled=False) # enable Export button
-            window['ADate'](disabled=True) # freeze session ID
-            x,y,yerr,xref,yref,prn = results.fit_data()
-            update_fig(x,y,yerr,xref,yref) # plot results
-            window['Chi']('%.3f' % prn)
-            if Chi_threshold[0] <= prn <= Chi_threshold[1]:
-                window['Chi'](background_color='green')
-                session.LinearityPass = 'PASS'
+
+            # update GUI
+            if session_analysed:
+                window['-CSV_WRITE-'](disabled=False) # enable Export button
+                window['-Archive-'](disabled=False) # enable Archive button
+                window['-Submit-'](disabled=False) # enable Export button
+                window['ADate'](disabled=True) # freeze session ID
+                x,y,yerr,xref,yref,prn = results.fit_data()
+                plot.update(x,y,yerr,xref,yref) # plot results
+                window['Chi']('%.3f' % prn)
+                if Chi_threshold[0] <= prn <= Chi_threshold[1]:
+                    window['Chi'](background_color='green')
+                    session.LinearityPass = 'PASS'
+                else:
+                    window['Chi'](background_color='red')  
+                    session.LinearityPass = 'FAIL'      
+                low, high, p_pass = results.chi_uncertainty(Chi_threshold)
+                window['ChiCI']('%.3f - %.3f' % (low, high))
+                window['ChiP']('%.1f' % (p_pass*100))
+            session.VarPass = 'PASS'
+            n=0
+            for i in range(1,len(mu_list)+1):
+                if n<len(results.MUindex) and i == results.MUindex[n]:
+                    rm_idx = grid.mean_key(i-1)
+                    window[rm_idx]('%.3f' % results.Rmean[n]) # format mean to 3dp
+                    dr_idx = grid.cov_key(i-1)
+                    cov = results.cov[n]
+                    window[dr_idx]('%.3f' % cov) # format diff to 3dp
+                    if abs(cov)>CoV_threshold:
+                        window[dr_idx](background_color='red')
+                        session.VarPass = 'FAIL'
+                        results.VarPass[n] = 'FAIL'
+                    else:
+                        window[dr_idx](background_color='green')
+                        results.VarPass[n] = 'PASS'
+                    n+=1
+                else:
+                    rm_idx = grid.mean_key(i-1)
+                    dr_idx = grid.cov_key(i-1)
+                    window[rm_idx]('', background_color='lightgray')
+                    window[dr_idx]('', background_color='lightgray')
+            # for i in range(len(results.MUindex)):
+            #     rm_idx = 'rm'+ results.MUindex[i]
+            #     window[rm_idx]('%.3f' % results.Rmean[i]) # format mean to 3dp
+            #     dr_idx = 'dr'+results.MUindex[i]
+            #     cov = results.cov[i]
+            #     window[dr_idx]('%.3f' % cov) # format diff to 3dp
+            #     if abs(cov)>CoV_threshold:
+            #         window[dr_idx](background_color='red')
+            #     else:
+            #         window[dr_idx](background_color='green')
+
+
+        if event == '-Export-': ### Export results to csv
+            if session_analysed and values['-Export-'] != '':
+                #session csv
+                export_csv(data=session, keys=session_keys, new_keys=new_keys, dname=values['-Export-'])
+                #results csv
+                export_csv(data=results, keys=results_keys, dname=values['-Export-'])
+            elif values['-Export-'] == '':
+                sg.popup('Directory Not Selected', 'Choose a valid directory')
             else:
-                window['Chi'](background_color='red')  
-                session.LinearityPass = 'FAIL'      
-        session.VarPass = 'PASS'
-        n=0
-        for i in range(1,len(mu_list)+1):
-            if n<len(results.MUindex) and str(i) == results.MUindex[n]:
-                rm_idx = 'rm'+ results.MUindex[n]
-                window[rm_idx]('%.3f' % results.Rmean[n]) # format mean to 3dp
-                dr_idx = 'dr'+results.MUindex[n]
-                cov = results.cov[n]
-                window[dr_idx]('%.3f' % cov) # format diff to 3dp
-                if abs(cov)>CoV_threshold:
-                    window[dr_idx](background_color='red')
-                    session.VarPass = 'FAIL'
-                    results.VarPass.append('FAIL')
+                sg.popup('Analysis Required', 'Analyse the session before exporting to csv')
+
+        if event == '-Archive-': ### Append results to the consolidated archive
+            if session_analysed:
+                checked, msg = field_check.check(values)
+                if checked:
+                    df_session = convert2df(session, session_keys, new_keys)
+                    df_results = convert2df(results, results_keys)
+                    try:
+                        if not ar.Archive().append(df_session, df_results):
+                            sg.popup('Archive', 'Session '+str(session.ADate)+' is already archived')
+                    except (ValueError, sqlite3.Error) as e:
+                        sg.popup('Archive Error', 'Session not archived: '+str(e))
                 else:
-                    window[dr_idx](background_color='green')
-                    results.VarPass.append('PASS')
-                n+=1
+                    print(msg)
             else:
-                rm_idx = 'rm'+str(i)
-                dr_idx = 'dr'+str(i)
-                window[rm_idx]('', background_color='lightgray')
-                window[dr_idx]('', background_color='lightgray')
-        # for i in range(len(results.MUindex)):
-        #     rm_idx = 'rm'+ results.MUindex[i]
-        #     window[rm_idx]('%.3f' % results.Rmean[i]) # format mean to 3dp
-        #     dr_idx = 'dr'+results.MUindex[i]
-        #     cov = results.cov[i]
-        #     window[dr_idx]('%.3f' % cov) # format diff to 3dp
-        #     if abs(cov)>CoV_threshold:
-        #         window[dr_idx](background_color='red')
-        #     else:
-        #         window[dr_idx](background_color='green')
-
-
-    if event == '-Export-': ### Export results to csv
-        if session_analysed and values['-Export-'] != '':
-            #session csv
-            export_csv(data=session, keys=session_keys, new_keys=new_keys, dname=values['-Export-'])
-            #results csv
-            export_csv(data=results, keys=results_keys, dname=values['-Export-'])
-        elif values['-Export-'] == '':
-            sg.popup('Directory Not Selected', 'Choose a valid directory')
-        else:
-            sg.popup('Analysis Required', 'Analyse the session before exporting to csv')
-            
-    if event == '-Clear-': ### Clear GUI fields and results
-        session_analysed=False
-        results.__init__()
-        session.__init__()
-        print("Session cleared.")
-        #except the following:
-        except_list = ['-CalB-', '-CSV_WRITE-','figCanvas'] # calendar button text
-        except_list.extend(['mu'+str(i) for i in range(6)]) # MU spot weights
-        except_list.extend(['-Rng'+str(i)+'-' for i in range(6)]) # electrometer range
-        for key in values:
-            if key not in except_list:
-                window[key]('')
-        for i in range(1,6):
-            window['dr'+str(i)]('', background_color='lightgray')
-            window['rm'+str(i)]('', background_color='lightgray')
-        window['Chi']('', background_color='lightgray')
-        window['ADate'](disabled=False) # freeze session ID
-        window['-AnalyseS-'](disabled=False) # freeze session ID
-        update_fig(None,None,None,x_ref,y_ref)
-
-    if event == sg.WIN_CLOSED or event == '-Cancel-': ### user closes window or clicks cancel
-        print("Session Ended.")
-        break
-
-    ### Populate Chamber ID list
-    if event == '-Chtype-':   # chamber type dictates chamber list
-        if values['-Chtype-'] == 'Roos':
-            Ch = Roos
-        elif values['-Chtype-'] == 'Semiflex':
-            Ch = Semiflex
-        else:
-            Ch = []
-        window['-Ch-'].update(values=Ch, value='') # update Ch combo box
+                sg.popup('Analysis Required', 'Analyse the session before archiving')
+
+        if event == '-Clear-': ### Clear GUI fields and results
+            perf.end_session(values['ADate'])
+            session_analysed=False
+            results.__init__()
+            session.__init__()
+            live.__init__(n_mu, n_repeats)
+            for key, i in mu_keys.items():
+                live.set_mu(i, values[key])
+            print("Session cleared.")
+            #except the following:
+            except_list = ['-CalB-', '-CSV_WRITE-','figCanvas'] # calendar button text
+            except_list.extend([grid.mu_key(i) for i in range(n_mu)]) # MU spot weights
+            except_list.extend([grid.range_key(i) for i in range(n_mu)]) # electrometer range
+            for key in values:
+                if key not in except_list:
+                    window[key]('')
+            for i in range(n_mu):
+                window[grid.cov_key(i)]('', background_color='lightgray')
+                window[grid.mean_key(i)]('', background_color='lightgray')
+            window['Chi']('', background_color='lightgray')
+            window['ChiCI']('')
+            window['ChiP']('')
+            window['ADate'](disabled=False) # freeze session ID
+            window['-AnalyseS-'](disabled=False) # freeze session ID
+            plot.update(None,None,None,x_ref,y_ref)
+
+        if event == sg.WIN_CLOSED or event == '-Cancel-': ### user closes window or clicks cancel
+            print("Session Ended.")
+            perf.end_session(session.ADate)
+            outbox.stop()
+            if acquisition is not None:
+                acquisition.stop()
+            break
+
+        ### Reference lists arrived from the database worker
+        if event == '-Fields-':
+            fields, connected = values['-Fields-']
+            G, Chtype, V, Rng, Op, Roos, Semiflex, _, El, _ = fields
+            field_check.update_lists(Op, G, Roos+Semiflex, El, [str(i) for i in V])
+            window['-Op1-'].update(values=Op, value=values['-Op1-'])
+            window['-Op2-'].update(values=Op, value=values['-Op2-'])
+            window['-G-'].update(values=G, value=values['-G-'])
+            window['-El-'].update(values=El, value=values['-El-'])
+            if values['-Chtype-'] in ['Roos', 'Semiflex']:
+                Ch = Roos if values['-Chtype-'] == 'Roos' else Semiflex
+                window['-Ch-'].update(values=Ch, value=values['-Ch-'])
+            if connected:
+                window['-Status-']('Database: connected (%.2f s)' % (time.perf_counter()-t_start), background_color='green')
+            else:
+                window['-Status-']('Database: cannot connect - export all measurements to .csv!', background_color='red')
+            print("Reference lists loaded in %.2f s" % (time.perf_counter()-t_start))
+
+        ### Outbox worker progress
+        if event == '-Outbox-':
+            pending, failed, msg = values['-Outbox-']
+            if failed:
+                window['-Queue-']('Outbox: %d queued, %d failed - %s' % (pending, failed, msg), background_color='red')
+            else:
+                window['-Queue-']('Outbox: %d queued - %s' % (pending, msg),
+                                  background_color=sg.theme_text_element_background_color())
+
+        ### Populate Chamber ID list
+        if event == '-Chtype-':   # chamber type dictates chamber list
+            if values['-Chtype-'] == 'Roos':
+                Ch = Roos
+            elif values['-Chtype-'] == 'Semiflex':
+                Ch = Semiflex
+            else:
+                Ch = []
+            window['-Ch-'].update(values=Ch, value='') # update Ch combo box
+
+    window.close()
+
 
-window.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Durable write-behind outbox for database submissions
+Sessions are queued in a local SQLite file and drained to the QA database
+by a background worker with retry and exponential backoff. Queued sessions
+survive restarts and are deduplicated on ADate. Sessions the database
+rejects are dead-lettered (kept, marked failed) instead of retried forever.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import database_df as db
+
+OUTBOX_PATH = os.path.join(os.path.expanduser('~'), '.doselinearity', 'outbox.sqlite')
+BACKOFF_BASE = 5 # seconds before the first retry
+BACKOFF_MAX = 600 # longest wait between retries
+POLL_INTERVAL = 30 # seconds between checks when idle
+MAX_ATTEMPTS = 8 # failed writes before a session is dead-lettered; connection outages do not count
+PERMANENT_ERRORS = ('IntegrityError', 'DataError', 'ValueError', 'TypeError', 'KeyError') # not worth retrying
+
+
+def _dumps(df):
+    '''Dataframe as split-orient JSON; floats are written with repr so no precision is lost'''
+    rows = [[v.item() if hasattr(v, 'item') else v for v in row] for row in df.itertuples(index=False)]
+    return json.dumps({'columns': list(df.columns), 'data': rows}, default=str)
+
+
+def _loads(text):
+    import pandas as pd
+    frame = json.loads(text)
+    return pd.DataFrame(frame['data'], columns=frame['columns'])
+
+
+class Outbox():
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        self.callback = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    ADate TEXT PRIMARY KEY,
+                    session TEXT NOT NULL,
+                    results TEXT NOT NULL,
+                    queued REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_try REAL NOT NULL,
+                    last_error TEXT,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0)
+            ''')
+            # outbox files created before dead-lettering get the columns added
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(outbox)')]
+            for column in ['failures', 'failed']:
+                if column not in columns:
+                    conn.execute('ALTER TABLE outbox ADD COLUMN %s INTEGER NOT NULL DEFAULT 0' % column)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def enqueue(self, df_session, df_results):
+        '''Queue a session for writing; return False if that ADate is already queued. Replaces a failed entry.'''
+        adate = str(df_session['ADate'].iloc[0])
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM outbox WHERE ADate = ? AND failed = 1', (adate,))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO outbox (ADate, session, results, queued, next_try) VALUES (?,?,?,?,?)',
+                (adate, _dumps(df_session), _dumps(df_results), now, now))
+            queued = cursor.rowcount == 1
+        if queued:
+            print("Session "+adate+" queued for database.")
+        else:
+            print("Session "+adate+" already queued.")
+        self._wake.set()
+        return queued
+
+    def pending(self):
+        '''Number of sessions waiting to be written'''
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM outbox WHERE failed = 0').fetchone()[0]
+
+    def failed(self):
+        '''Number of dead-lettered sessions'''
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM outbox WHERE failed = 1').fetchone()[0]
+
+    def dead_letters(self):
+        '''(ADate, attempts, last_error) of every dead-lettered session, oldest first'''
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT ADate, attempts, last_error FROM outbox WHERE failed = 1 ORDER BY queued').fetchall()
+
+    def _due(self):
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT ADate, session, results, attempts, failures FROM outbox WHERE failed = 0 AND next_try <= ? '
+                'ORDER BY queued',
+                (time.time(),)).fetchall()
+
+    def _next_try(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT MIN(next_try) FROM outbox WHERE failed = 0').fetchone()[0]
+
+    def _done(self, adate):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM outbox WHERE ADate = ?', (adate,))
+
+    def _retry(self, adate, attempts, error, failures=0):
+        # attempts drives the backoff; failures counts only writes that reached the database
+        delay = min(BACKOFF_MAX, BACKOFF_BASE*2**attempts)
+        with self._connect() as conn:
+            conn.execute('UPDATE outbox SET attempts = ?, next_try = ?, last_error = ?, failures = ? WHERE ADate = ?',
+                (attempts+1, time.time()+delay, error, failures, adate))
+
+    def _dead_letter(self, adate, attempts, error, failures):
+        with self._connect() as conn:
+            conn.execute('UPDATE outbox SET attempts = ?, last_error = ?, failures = ?, failed = 1 WHERE ADate = ?',
+                (attempts+1, error, failures, adate))
+
+    def _notify(self, msg):
+        print(msg)
+        if self.callback:
+            self.callback(self.pending(), self.failed(), msg)
+
+    def drain(self):
+        '''Write all due sessions to the database; return the number written'''
+        written = 0
+        for adate, session, results, attempts, failures in self._due():
+            exists = db.session_exists(adate)
+            if exists is None:
+                self._retry(adate, attempts, 'cannot connect', failures)
+                self._notify("Database unavailable, session "+adate+" kept in outbox")
+                break
+            if exists:
+                self._done(adate)
+                self._notify("Session "+adate+" already in database, removed from outbox")
+                continue
+            df_session = _loads(session)
+            df_results = _loads(results)
+            permanent = False
+            try:
+                ok = db.write_to_db(df_session, df_results, popup=False)
+                # write_to_db only returns False on an integrity error or a lost connection
+                permanent = not ok and db.session_exists(adate) is not None
+                error = 'rejected by database (integrity error)' if permanent else 'write failed'
+            except Exception as e:
+                ok = False
+                permanent = type(e).__name__ in PERMANENT_ERRORS
+                error = type(e).__name__+': '+str(e)
+            if ok:
+                self._done(adate)
+                written += 1
+                self._notify("Session "+adate+" written to database")
+            elif permanent or failures+1 >= MAX_ATTEMPTS:
+                self._dead_letter(adate, attempts, error, failures+1)
+                self._notify("Session "+adate+" failed: "+error+" - export it to .csv")
+            else:
+                self._retry(adate, attempts, error, failures+1)
+                self._notify("Write failed for session "+adate+", will retry")
+        return written
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                print("Outbox error: "+str(e))
+            wait = POLL_INTERVAL
+            next_try = self._next_try()
+            if next_try is not None:
+                wait = max(0, min(POLL_INTERVAL, next_try-time.time()))
+            self._wake.wait(wait)
+
+    def start(self, callback=None):
+        '''Start the background worker; callback(pending, failed, message) after each attempt'''
+        self.callback = callback
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
@@ -0,0 +1,155 @@
+"""
+Opt-in timing instrumentation
+Set DOSELINEARITY_PERF=1 (or call perf.enable()) to time the database,
+analysis and rendering hot paths. Spans are collected per session and
+appended as one JSON line to the performance log when the session ends;
+python perf.py prints a summary report of the log.
+
+usage: python perf.py [--log PATH] [--last N]
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+LOG_PATH = os.path.join(os.path.expanduser('~'), '.doselinearity', 'perf.jsonl')
+ENABLED = os.environ.get('DOSELINEARITY_PERF', '') not in ('', '0')
+
+_lock = threading.Lock()
+_spans = [] # spans of the current session
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+class _Span():
+    __slots__ = ['name', 'info', 't0']
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record = {'name': self.name, 'start': self.t0, 'seconds': time.perf_counter()-self.t0,
+                  'thread': threading.current_thread().name}
+        if self.info:
+            record.update(self.info)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        with _lock:
+            _spans.append(record)
+        return False
+
+
+class _NoSpan():
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **info):
+    '''Context manager timing a block as a named span; does nothing unless enabled'''
+    return _Span(name, info) if ENABLED else _NO_SPAN
+
+
+def timed(name):
+    '''Decorator timing every call as a named span'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _Span(name, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def end_session(session, path=LOG_PATH, **info):
+    '''Append the spans collected since the last call as one per-session record; return it'''
+    global _spans
+    with _lock:
+        spans, _spans = _spans, []
+    if not ENABLED or not spans:
+        return None
+    totals = {}
+    for s in spans:
+        totals[s['name']] = totals.get(s['name'], 0.)+s['seconds']
+    t0 = min(s['start'] for s in spans)
+    for s in spans:
+        s['start'] -= t0 # seconds from the first span of the session
+    record = {'session': str(session), 'logged': datetime.datetime.now().isoformat(timespec='seconds'),
+              'totals': totals, 'spans': spans}
+    record.update(info)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=str)+'\n')
+    except OSError:
+        print("Could not write performance log: "+path)
+    return record
+
+
+def load(path=LOG_PATH, last=None):
+    '''Per-session records from the performance log, oldest first'''
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return records[-last:] if last else records
+
+
+def summary(records):
+    '''{span name: {count, total, mean, p50, p95, max}} over every span in the records'''
+    import numpy as np
+    times = {}
+    for record in records:
+        for s in record['spans']:
+            times.setdefault(s['name'], []).append(s['seconds'])
+    out = {}
+    for name, t in times.items():
+        t = np.array(t)
+        out[name] = {'count': t.size, 'total': t.sum(), 'mean': t.mean(),
+                     'p50': np.percentile(t, 50), 'p95': np.percentile(t, 95), 'max': t.max()}
+    return out
+
+
+def report(records):
+    '''Summary table as text, slowest total first'''
+    rows = sorted(summary(records).items(), key=lambda kv: -kv[1]['total'])
+    lines = ['%d sessions' % len(records),
+             '%-28s %7s %10s %10s %10s %10s %10s' % ('span', 'count', 'total s', 'mean ms', 'p50 ms', 'p95 ms', 'max ms')]
+    for name, s in rows:
+        lines.append('%-28s %7d %10.3f %10.2f %10.2f %10.2f %10.2f' % (
+            name, s['count'], s['total'], s['mean']*1e3, s['p50']*1e3, s['p95']*1e3, s['max']*1e3))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise the DoseLinearity performance log')
+    parser.add_argument('--log', default=LOG_PATH, help='performance log to read')
+    parser.add_argument('--last', type=int, default=None, help='only the last N sessions')
+    args = parser.parse_args()
+    print(report(load(args.log, args.last)))
@@ -0,0 +1,137 @@
+"""
+Persistent on-disk cache for database reference lists (Operators, Assets)
+Entries are keyed by table and filter, stamped with the fetch time, an
+etag (hash of the data) and a cheap table version (row count and key range).
+Stale entries whose version is unchanged are renewed without refetching (up
+to MAX_AGE, since the version misses in-place edits), and the file is only rewritten with new data when the lists have actually changed.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.doselinearity', 'refcache.json')
+CACHE_VERSION = 1
+TTL = 24*3600 # seconds before an entry is refreshed from the database
+MAX_AGE = 7*TTL # seconds before a full fetch is forced even if the version is unchanged
+
+
+def cache_key(table, target, filter_var=None, filter_val=None):
+    '''Key for a table/target lookup with an optional filter'''
+    key = table+'.'+target
+    if filter_var:
+        key += '?'+filter_var+'='+str(filter_val)
+    return key
+
+
+def _etag(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class RefCache():
+    def __init__(self, path=CACHE_PATH, ttl=TTL, max_age=MAX_AGE):
+        self.path = path
+        self.ttl = ttl
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''Read the cache file; discard it if missing, corrupt or from another version'''
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            if cache.get('version') == CACHE_VERSION:
+                self.entries = cache['entries']
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def save(self):
+        '''Write the cache file atomically'''
+        with self.lock:
+            cache = {'version': CACHE_VERSION, 'entries': self.entries}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = self.path+'.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                print("Could not write reference cache: "+self.path)
+
+    def get(self, key):
+        '''Cached list for key regardless of age, or None'''
+        entry = self.entries.get(key)
+        return list(entry['data']) if entry else None
+
+    def stale(self, key):
+        entry = self.entries.get(key)
+        return entry is None or time.time()-entry.get('checked', entry['fetched']) > self.ttl
+
+    def any_stale(self, keys):
+        return any(self.stale(k) for k in keys)
+
+    def put(self, key, data, version=None):
+        '''Store data for key; return True if it differs from the cached etag'''
+        etag = _etag(data)
+        with self.lock:
+            entry = self.entries.get(key)
+            changed = entry is None or entry['etag'] != etag
+            now = time.time()
+            self.entries[key] = {'fetched': now, 'checked': now, 'etag': etag, 'version': version, 'data': list(data)}
+        return changed
+
+    def update(self, lookups, versions=None):
+        '''Store {key: data} ignoring failed (None/empty) lookups; save and return True if anything changed'''
+        changed = False
+        versions = versions or {}
+        for key, data in lookups.items():
+            if data:
+                changed = self.put(key, data, versions.get(key)) or changed
+        self.save()
+        return changed
+
+    def current(self, versions, keys):
+        '''True if every key is cached with the given (non-empty) version and fetched within max_age'''
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None or not versions.get(key) or entry.get('version') != versions[key]:
+                return False
+            if time.time()-entry['fetched'] > self.max_age:
+                return False
+        return True
+
+    def touch(self, keys):
+        '''Mark cached keys as checked against the database and save'''
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries[key]['checked'] = time.time()
+        self.save()
+
+    def refresh(self, fetch, keys, callback=None, force=False, version=None):
+        '''
+            Refresh stale keys on a background thread with fetch(); callback(changed) when done.
+            version() returns {key: version} cheaply; if the cached versions match, fetch is skipped.
+        '''
+        if not force and not self.any_stale(keys):
+            return None
+        def _worker():
+            try:
+                versions = version() if version else None
+                if versions and not force and self.current(versions, keys):
+                    self.touch(keys)
+                    changed = False
+                else:
+                    changed = self.update(fetch(), versions)
+            except Exception as e:
+                print("Reference cache refresh failed: "+str(e))
+                changed = None
+            if callback:
+                callback(changed)
+        thread = threading.Thread(target=_worker, daemon=True)
+        thread.start()
+        return thread
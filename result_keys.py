@@ -0,0 +1,50 @@
+"""
+Collision-free RTimestamp allocator for DoseLinearityResults
+Keys keep the 16 digit YYYYmmddHHMMSSff format previously written to
+RTimestamp, so they still fit a numeric column. The timestamp runs in
+deciseconds and the final digit is a node id for this workstation and
+process. The timestamp part acts as a logical clock: it never repeats
+within a process, so keys are unique and ordered without waiting for
+the wall clock.
+"""
+
+import datetime
+import hashlib
+import os
+import socket
+import threading
+
+TICK = datetime.timedelta(microseconds=100000)  # one decisecond
+
+
+def _node_id():
+    '''Digit 0-9 for this workstation and process'''
+    node = '%s:%d' % (socket.gethostname(), os.getpid())
+    return int(hashlib.sha1(node.encode()).hexdigest(), 16) % 10
+
+
+class KeyAllocator:
+    def __init__(self, node=None):
+        self.node = node % 10 if node is not None else _node_id()
+        self._last = None
+        self._lock = threading.Lock()
+
+    def _format(self, t):
+        return t.strftime("%Y%m%d%H%M%S%f")[:-5] + str(self.node)
+
+    def allocate(self, n):
+        '''Return n unique, ordered result keys'''
+        with self._lock:
+            t = datetime.datetime.now()
+            now = t.replace(microsecond=t.microsecond//100000*100000)
+            start = now if self._last is None or now > self._last else self._last + TICK
+            self._last = start + TICK*(n-1) if n > 0 else self._last
+        return [self._format(start + TICK*i) for i in range(n)]
+
+    def next_key(self):
+        '''Return a single result key'''
+        return self.allocate(1)[0]
+
+
+# module level allocator shared by the application
+allocator = KeyAllocator()
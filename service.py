@@ -0,0 +1,277 @@
+"""
+Headless dose linearity service for other QA tools
+A small asyncio HTTP/JSON server bound to localhost. Analysis, validation
+and database access run on a thread pool so slow Access I/O never blocks
+other requests. Submissions go through the outbox like the GUI.
+
+    POST /analyse   {"readings": [[[r, ...], ...], ...], "mu": [...], "weighted": false, "uncertainty": false}
+    POST /validate  {"records": [{field: value}, ...], "columns": "gui" | "db"}
+    POST /submit    {"session": {column: value}, "results": [{column: value}, ...]}  (session is validated first)
+    GET  /history?machine=Gantry%201&chamber=&energy_min=&energy_max=
+    GET  /metrics
+
+usage: python service.py [--host 127.0.0.1] [--port 8765] [--db PATH] [--password PW] [--sqlite PATH]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import analysis as an
+import database_df as db
+import field_check as fc
+import outbox as ob
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 4 # threads for analysis and database I/O
+MAX_BODY = 10*1024*1024 # bytes
+LATENCY_WINDOW = 1000 # recent requests kept per endpoint for latency percentiles
+REFRESH_INTERVAL = 600 # seconds between checks that the cached reference lists are fresh
+STATUS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+          500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, msg, violations=None):
+        super().__init__(msg)
+        self.status = status
+        self.violations = violations
+
+
+def _list(arr):
+    '''Array as a JSON list with nan/masked values as null'''
+    arr = np.ma.asarray(arr, dtype=float).filled(np.nan)
+    return np.where(np.isnan(arr), None, arr).tolist()
+
+
+class Metrics():
+    '''Request counts, errors and latency percentiles per endpoint'''
+    def __init__(self):
+        self.started = time.time()
+        self.count = collections.Counter()
+        self.errors = collections.Counter()
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+
+    def record(self, endpoint, seconds, ok):
+        self.count[endpoint] += 1
+        if not ok:
+            self.errors[endpoint] += 1
+        self.latency[endpoint].append(seconds*1000)
+
+    def report(self):
+        endpoints = {}
+        for endpoint, times in self.latency.items():
+            t = np.array(times)
+            endpoints[endpoint] = {
+                'requests': self.count[endpoint], 'errors': self.errors[endpoint],
+                'mean_ms': t.mean(), 'p50_ms': np.percentile(t, 50), 'p95_ms': np.percentile(t, 95),
+                'max_ms': t.max()}
+        return {'uptime_s': time.time()-self.started, 'endpoints': endpoints}
+
+
+class Service():
+    def __init__(self, workers=WORKERS, outbox=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.metrics = Metrics()
+        self.outbox = outbox or ob.Outbox()
+        self.routes = {
+            ('POST', '/analyse'): self.analyse,
+            ('POST', '/validate'): self.validate,
+            ('POST', '/submit'): self.submit,
+            ('GET', '/history'): self.history,
+            ('GET', '/metrics'): self.report,
+        }
+        self._validators = {}
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    ### endpoints
+    def _analyse(self, body):
+        try:
+            readings = an.readings_array(body['readings'])
+            mu = an.mu_array([body['mu']] if np.ndim(body['mu']) == 1 else body['mu'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPError(400, 'readings and mu are required: '+str(e))
+        res = an.analyse(readings, mu, body.get('weighted', False))
+        out = {k: _list(getattr(res, k)) for k in
+               ['MU', 'Rmean', 'Rstd', 'cov', 'Rratio', 'MUratio', 'Rdifflinearity', 'slope', 'slope_err', 'prn']}
+        out['analysed'] = res.analysed.tolist()
+        if body.get('uncertainty'):
+            out['prn_interval'] = []
+            for s in range(res.prn.size):
+                valid = ~res.Rmean.mask[s]
+                if res.analysed[s]:
+                    low, high, p_pass = an.chi_uncertainty(res.MU[s][valid], res.Rmean[s][valid],
+                        res.Rstd[s][valid], res.n[s][valid], body.get('chi_threshold', an.CHI_THRESHOLD))
+                    out['prn_interval'].append({'low': low, 'high': high, 'p_pass': p_pass})
+                else:
+                    out['prn_interval'].append(None)
+        return out
+
+    async def analyse(self, query, body):
+        return 200, await self._run(self._analyse, body)
+
+    def _validator(self, columns):
+        # dropdown lists come from the reference cache; compiled once per column naming
+        if columns not in self._validators:
+            G, Chtype, V, Rng, Op, Roos, Semiflex, Ch, El, _ = db.populate_fields(fetch=False)
+            lookups = {'Op': Op, 'G': G, 'Ch': Roos+Semiflex, 'El': El, 'V': V}
+            schema = fc.SCHEMA if columns == 'db' else fc.SCHEMA+fc.reading_rules()
+            self._validators[columns] = fc.Validator(schema, lookups, fc.COLUMNS if columns == 'db' else None)
+        return self._validators[columns]
+
+    def _lists_refreshed(self, fields, connected):
+        # validators are rebuilt from the refreshed reference cache on next use
+        self._validators = {}
+
+    async def _refresh_lists(self):
+        while True:
+            db.refresh_fields(self._lists_refreshed)
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    async def validate(self, query, body):
+        records = body.get('records')
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise HTTPError(400, 'records must be a list of objects')
+        columns = body.get('columns', 'gui')
+        violations = self._validator(columns).validate_batch(records)
+        return 200, {'valid': not violations, 'violations': [v._asdict() for v in violations]}
+
+    def _submit(self, body):
+        import pandas as pd
+        if not isinstance(body.get('session'), dict):
+            raise HTTPError(400, 'session must be an object of database columns')
+        violations = self._validator('db').validate(body['session'])
+        if violations:
+            raise HTTPError(400, 'invalid session: '+fc.report(violations).replace('\n', '; '),
+                            [v._asdict() for v in violations])
+        try:
+            df_session = pd.DataFrame([body['session']])[db.SESSION_COLUMNS]
+            df_results = pd.DataFrame(body['results'])[db.RESULTS_COLUMNS]
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPError(400, 'session and results need the database columns: '+str(e))
+        return self.outbox.enqueue(df_session, df_results)
+
+    async def submit(self, query, body):
+        queued = await self._run(self._submit, body)
+        return 202, {'queued': queued, 'pending': await self._run(self.outbox.pending)}
+
+    def _history(self, query):
+        def arg(name, cast=str):
+            value = query.get(name, [''])[0]
+            return cast(value) if value != '' else None
+        if not arg('machine'):
+            raise HTTPError(400, 'machine is required')
+        try:
+            chunks = db.query_history(arg('machine'), arg('chamber'), arg('energy_min', float), arg('energy_max', float))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        trends = an.history_trends(chunks)
+        out = {k: [str(x) for x in trends[k]] for k in ['ADate', 'MachineName', 'Chamber']}
+        out.update({k: _list(trends[k]) for k in ['Energy', 'deviation', 'cov', 'prn', 'slope']})
+        out['analysed'] = trends['analysed'].tolist()
+        return out
+
+    async def history(self, query, body):
+        return 200, await self._run(self._history, query)
+
+    async def report(self, query, body):
+        return 200, self.metrics.report()
+
+    ### HTTP
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, 'malformed request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            raise HTTPError(413, 'request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return method, target, body
+
+    async def handle(self, reader, writer):
+        t0 = time.perf_counter()
+        endpoint = 'invalid'
+        status = 500
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                writer.close()
+                return
+            method, target, raw = request
+            url = urllib.parse.urlsplit(target)
+            endpoint = method+' '+url.path
+            route = self.routes.get((method, url.path))
+            if route is None:
+                raise HTTPError(404, 'no endpoint '+endpoint)
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                raise HTTPError(400, 'body is not valid JSON')
+            status, out = await route(urllib.parse.parse_qs(url.query), body)
+        except HTTPError as e:
+            status, out = e.status, {'error': str(e)}
+            if e.violations:
+                out['violations'] = e.violations
+        except Exception as e:
+            print("Service error on "+endpoint+": "+str(e))
+            status, out = 500, {'error': str(e)}
+        try:
+            data = json.dumps(out, default=float).encode()
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (status, STATUS[status], len(data))).encode()+data)
+            await writer.drain()
+        finally:
+            writer.close()
+            self.metrics.record(endpoint, time.perf_counter()-t0, status < 400)
+
+    async def serve(self, host=HOST, port=PORT):
+        self.outbox.start()
+        refresh = asyncio.create_task(self._refresh_lists())
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Dose linearity service on http://%s:%d" % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresh.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local dose linearity analysis service')
+    parser.add_argument('--host', default=HOST, help='address to bind (keep to localhost)')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--db', help='path to the Access database')
+    parser.add_argument('--password', help='database password')
+    parser.add_argument('--sqlite', help='use this SQLite file instead of the Access database')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads for analysis and database I/O')
+    args = parser.parse_args()
+    if args.db:
+        db.DB_PATH = args.db
+    if args.password:
+        db.PASSWORD = args.password
+    if args.sqlite:
+        db.set_backend(db.SQLiteBackend(args.sqlite))
+    try:
+        asyncio.run(Service(args.workers).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Service stopped.")
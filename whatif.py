@@ -0,0 +1,166 @@
+"""
+What-if re-evaluation of historical sessions under new action levels
+Loads the stored readings for each gantry, re-analyses them and sweeps a
+grid of (CoV threshold, chi upper limit) pairs in a process pool, counting
+the sessions that pass and the sessions whose result flips relative to the
+current action levels. One summary matrix is printed per gantry.
+
+usage: python whatif.py [--machines G1 G2] [--archive PATH | --db PATH | --sqlite PATH]
+                        [--cov 0.3 0.5 1.0] [--chi 0.1 0.2 0.5] [--workers N] [--report CSV] [--sessions CSV]
+"""
+
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analysis as an
+import database_df as db
+
+COV_GRID = [0.25, 0.5, 0.75, 1.0, 1.5, 2.0] # CoV thresholds (%) to try
+CHI_GRID = [0.05, 0.1, 0.2, 0.3, 0.5, 1.0] # chi upper limits to try
+CHUNK_SESSIONS = 500 # sessions per worker task
+
+
+def load_history(machine, archive=None):
+    '''(sessions, readings, mu) for one gantry from the archive or the database'''
+    chunks = archive.history(machine) if archive else db.query_history(machine)
+    return an.history_arrays(chunks)
+
+
+def evaluate(readings, mu, cov_grid, chi_grid, chi_low=an.CHI_THRESHOLD[0],
+             current=(an.COV_THRESHOLD, an.CHI_THRESHOLD[1])):
+    '''
+        Re-analyse a chunk of sessions and apply every threshold pair.
+        Returns (passed, now): passed is (len(cov_grid), len(chi_grid), sessions),
+        now is pass/fail of each session at the current action levels.
+    '''
+    res = an.analyse(readings, mu)
+    cov_max = np.abs(res.cov).max(axis=1).filled(np.inf)
+    prn = res.prn
+    cov_grid = np.asarray(cov_grid, dtype=float)
+    chi_grid = np.asarray(chi_grid, dtype=float)
+    with np.errstate(invalid='ignore'):
+        cov_pass = cov_max[None, :] <= cov_grid[:, None]
+        chi_pass = (prn >= chi_low)[None, :] & (prn[None, :] <= chi_grid[:, None])
+        now = res.analysed & (cov_max <= current[0]) & (prn >= chi_low) & (prn <= current[1])
+    passed = cov_pass[:, None, :] & chi_pass[None, :, :] & res.analysed
+    return passed, now
+
+
+def _chunks(readings, mu, size):
+    for start in range(0, readings.shape[0], size):
+        yield readings[start:start+size], mu[start:start+size]
+
+
+class Sweep():
+    '''Pass/fail of every session of every gantry over the threshold grid'''
+    def __init__(self, cov_grid=COV_GRID, chi_grid=CHI_GRID):
+        self.cov_grid = list(cov_grid)
+        self.chi_grid = list(chi_grid)
+        self.sessions = {} # machine -> session metadata
+        self.passed = {} # machine -> (cov, chi, sessions) bool
+        self.now = {} # machine -> (sessions,) bool
+
+    def run(self, machines, archive=None, workers=None):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            for machine in machines:
+                sessions, readings, mu = load_history(machine, archive)
+                self.sessions[machine] = sessions
+                print("%s: %d sessions" % (machine, sessions['ADate'].size))
+                for r, m in _chunks(readings, mu, CHUNK_SESSIONS):
+                    futures.append((machine, pool.submit(evaluate, r, m, self.cov_grid, self.chi_grid)))
+            parts = {}
+            for machine, future in futures:
+                parts.setdefault(machine, []).append(future.result())
+        for machine in self.sessions:
+            if machine in parts:
+                self.passed[machine] = np.concatenate([p[0] for p in parts[machine]], axis=2)
+                self.now[machine] = np.concatenate([p[1] for p in parts[machine]])
+            else:
+                self.passed[machine] = np.zeros((len(self.cov_grid), len(self.chi_grid), 0), dtype=bool)
+                self.now[machine] = np.zeros(0, dtype=bool)
+        return self
+
+    def summary(self, machine):
+        '''Dataframes indexed by CoV threshold, columns chi limit: sessions passing, newly failing, newly passing'''
+        import pandas as pd
+        passed, now = self.passed[machine], self.now[machine]
+        frames = {
+            'pass': passed.sum(axis=2),
+            'newly_fail': (~passed & now).sum(axis=2),
+            'newly_pass': (passed & ~now).sum(axis=2),
+        }
+        index = pd.Index(self.cov_grid, name='CoV threshold')
+        columns = pd.Index(self.chi_grid, name='Chi limit')
+        return {k: pd.DataFrame(v, index=index, columns=columns) for k, v in frames.items()}
+
+    def report(self):
+        '''Long-form table: one row per gantry and threshold pair'''
+        import pandas as pd
+        rows = []
+        for machine in self.passed:
+            passed, now = self.passed[machine], self.now[machine]
+            for (a, cov), (b, chi) in itertools.product(enumerate(self.cov_grid), enumerate(self.chi_grid)):
+                p = passed[a, b]
+                rows.append((machine, cov, chi, p.size, p.sum(), (~p & now).sum(), (p & ~now).sum()))
+        return pd.DataFrame(rows, columns=['MachineName', 'CoV threshold', 'Chi limit', 'Sessions', 'Pass',
+                                           'Newly fail', 'Newly pass'])
+
+    def flips(self):
+        '''Every session whose result changes, for every threshold pair'''
+        import pandas as pd
+        rows = []
+        for machine in self.passed:
+            passed, now = self.passed[machine], self.now[machine]
+            adate = self.sessions[machine]['ADate']
+            for a, b, s in zip(*np.nonzero(passed != now[None, None, :])):
+                rows.append((machine, str(adate[s]), self.cov_grid[a], self.chi_grid[b],
+                             'PASS' if now[s] else 'FAIL', 'PASS' if passed[a, b, s] else 'FAIL'))
+        return pd.DataFrame(rows, columns=['MachineName', 'ADate', 'CoV threshold', 'Chi limit', 'Now', 'Then'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-evaluate historical sessions under new action levels')
+    parser.add_argument('--machines', nargs='+', help='gantries to evaluate (default: all known)')
+    parser.add_argument('--archive', help='read history from this consolidated archive')
+    parser.add_argument('--db', help='path to the Access database')
+    parser.add_argument('--password', help='database password')
+    parser.add_argument('--sqlite', help='read history from this SQLite database')
+    parser.add_argument('--cov', type=float, nargs='+', default=COV_GRID, help='CoV thresholds (%%)')
+    parser.add_argument('--chi', type=float, nargs='+', default=CHI_GRID, help='chi upper limits')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes')
+    parser.add_argument('--report', help='write the per-gantry summary to this csv')
+    parser.add_argument('--sessions', help='write every flipped session to this csv')
+    args = parser.parse_args()
+    if args.db:
+        db.DB_PATH = args.db
+    if args.password:
+        db.PASSWORD = args.password
+    if args.sqlite:
+        db.set_backend(db.SQLiteBackend(args.sqlite))
+    archive = None
+    if args.archive:
+        import archive as ar
+        archive = ar.Archive(args.archive)
+    machines = args.machines
+    if not machines:
+        machines = archive.machines() if archive else db.populate_fields()[0]
+
+    sweep = Sweep(args.cov, args.chi).run(machines, archive, args.workers)
+    print("Current action levels: CoV <= %.2f %%, %.2f <= chi <= %.2f" % (
+        an.COV_THRESHOLD, an.CHI_THRESHOLD[0], an.CHI_THRESHOLD[1]))
+    for machine in machines:
+        tables = sweep.summary(machine)
+        print("\n%s (%d sessions, %d pass now)" % (machine, sweep.now[machine].size, sweep.now[machine].sum()))
+        for name in ['pass', 'newly_fail', 'newly_pass']:
+            print(name.replace('_', ' ').capitalize()+':')
+            print(tables[name].to_string())
+    if args.report:
+        sweep.report().to_csv(args.report, index=False)
+        print("Saved: "+args.report)
+    if args.sessions:
+        sweep.flips().to_csv(args.sessions, index=False)
+        print("Saved: "+args.sessions)